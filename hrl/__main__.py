@@ -13,6 +13,7 @@ from hrl.wrappers.antmaze_wrapper import D4RLAntMazeWrapper
 from hrl.utils import create_log_dir
 from hrl.agent.dsc.dsc import RobustDSC
 from hrl.agent.dsc.dst import RobustDST
+from hrl.agent.dsc.utils import DynamicsModelSchedule
 
 
 if __name__ == "__main__":
@@ -33,7 +34,76 @@ if __name__ == "__main__":
     parser.add_argument("--use_value_function", action="store_true", default=False)
     parser.add_argument("--use_global_value_function", action="store_true", default=False)
     parser.add_argument("--use_model", action="store_true", default=False)
-    parser.add_argument("--multithread_mpc", action="store_true", default=False)
+    parser.add_argument("--multithread_mpc", action="store_true", default=False,
+                        help="shard the MPC rollouts across a pool of planning threads")
+    parser.add_argument("--mpc_planner", type=str, default="random", choices=["random", "cem", "mppi"],
+                        help="random shooting, or iterative CEM/MPPI refinement of the action distribution")
+    parser.add_argument("--mpc_num_rollouts", type=int, default=None,
+                        help="number of sampled action sequences (per planner iteration for cem/mppi); "
+                             "defaults to 14000 for random and 2000 for cem/mppi")
+    parser.add_argument("--mpc_warm_start_fraction", type=float, default=0.,
+                        help="fraction of the population seeded from the previous step's shifted plan (0 disables)")
+    parser.add_argument("--mpc_compiled_inference", action="store_true", default=False,
+                        help="plan with a TorchScript copy of the dynamics model with standardization folded in")
+    parser.add_argument("--mpc_ensemble_size", type=int, default=1,
+                        help="number of members in a probabilistic dynamics-model ensemble (1 = single deterministic model)")
+    parser.add_argument("--mpc_inference_precision", type=str, default="float32", choices=["float32", "bfloat16", "int8"],
+                        help="planning-only precision of the dynamics model (training stays in float32)")
+    parser.add_argument("--mpc_student_hidden_size", type=int, default=0,
+                        help="if > 0, plan with a student dynamics model of this width distilled from the full model")
+    parser.add_argument("--mpc_student_rescore_top_k", type=int, default=0,
+                        help="re-simulate this many of the best student rollouts with the full model before acting")
+    parser.add_argument("--mpc_planning_workers", type=int, default=0,
+                        help="number of planning threads with --multithread_mpc (required, > 1)")
+    parser.add_argument("--torch_num_threads", type=int, default=0,
+                        help="torch intra-op threads of the whole process, shared by the planning workers and every "
+                             "other thread (0 keeps torch's default)")
+    parser.add_argument("--mpc_adaptive_sampling", action="store_true", default=False,
+                        help="random shooting over Sobol samples in chunks, stopping once the best cost stops improving")
+    parser.add_argument("--mpc_sample_chunk_size", type=int, default=2048,
+                        help="samples per chunk with --mpc_adaptive_sampling (--mpc_num_rollouts is the maximum)")
+    parser.add_argument("--dynamics_training_schedule", type=str, default="epochs", choices=["epochs", "fixed_steps"],
+                        help="train the dynamics model for 5 epochs per episode, or for a fixed number of gradient steps")
+    parser.add_argument("--dynamics_gradient_steps", type=int, default=500,
+                        help="gradient steps per episode (or per --dynamics_train_every env steps) for fixed_steps")
+    parser.add_argument("--dynamics_train_every", type=int, default=0,
+                        help="if > 0, spend --dynamics_gradient_steps per this many env steps of the episode")
+    parser.add_argument("--dynamics_recent_fraction", type=float, default=0.5,
+                        help="fraction of each fixed_steps minibatch drawn from the most recent transitions")
+    parser.add_argument("--dynamics_drift_error_ratio", type=float, default=0.,
+                        help="if > 0, only retrain the dynamics model when its one-step error exceeds this multiple of its training error")
+    parser.add_argument("--dynamics_drift_state_shift", type=float, default=1.,
+                        help="also retrain when the mean visited state moves by this many std from the training mean")
+    parser.add_argument("--dynamics_distill_steps", type=int, default=1000,
+                        help="gradient steps of student distillation after every dynamics model update")
+    parser.add_argument("--action_chunk_size", type=int, default=1,
+                        help="planned actions model-based options execute open loop before replanning")
+    parser.add_argument("--global_action_chunk_size", type=int, default=0,
+                        help="--action_chunk_size of the global option (0 = same as the other options)")
+    parser.add_argument("--replan_tolerance", type=float, default=0.5,
+                        help="replan (or drop a speculative plan) when the observed position is this far from the predicted one")
+    parser.add_argument("--speculative_planning", action="store_true", default=False,
+                        help="plan the next step from the predicted next state while the simulator steps")
+    parser.add_argument("--value_gradient_steps", type=int, default=0,
+                        help="TD3 gradient steps after every option rollout (0 = one per hindsight-relabeled transition)")
+    parser.add_argument("--shared_transition_store", action="store_true", default=False,
+                        help="keep each environment transition once, shared by the dynamics model and all TD3 learners")
+    parser.add_argument("--td3_replay_storage", type=str, default="numpy", choices=["numpy", "torch"],
+                        help="torch: TD3 replay buffers in one float32 tensor on the device, sampled with index_select")
+    parser.add_argument("--td3_prefetch_batches", action="store_true", default=False,
+                        help="gather the next TD3 minibatch on a background thread (torch replay storage only)")
+    parser.add_argument("--td3_fused_critic", action="store_true", default=False,
+                        help="evaluate both TD3 critics as one batched matmul and update the targets with _foreach ops")
+    parser.add_argument("--td3_compile_update", action="store_true", default=False,
+                        help="torch.compile the TD3 critic and actor losses (torch>=2.0)")
+    parser.add_argument("--td3_numpy_inference", action="store_true", default=False,
+                        help="select TD3 actions with NumPy matmuls on a cached copy of the actor weights")
+    parser.add_argument("--async_learning", action="store_true", default=False,
+                        help="train the TD3 learners and the dynamics model on background threads while acting")
+    parser.add_argument("--value_update_to_data_ratio", type=float, default=1.,
+                        help="TD3 updates per relabeled transition of the background learners (--async_learning)")
+    parser.add_argument("--value_publish_every", type=int, default=100,
+                        help="updates between copies of the background learners' weights to the acting policy")
     parser.add_argument("--use_diverse_starts", action="store_true", default=False)
     parser.add_argument("--use_dense_rewards", action="store_true", default=False)
     parser.add_argument("--logging_frequency", type=int, default=50, help="Draw init sets, etc after every _ episodes")
@@ -57,6 +127,20 @@ if __name__ == "__main__":
     if args.use_skill_trees:
         assert args.max_num_children > 1, f"{args.use_skill_trees, args.max_num_children}"
 
+    if args.multithread_mpc:
+        assert args.mpc_planning_workers > 1, f"{args.multithread_mpc, args.mpc_planning_workers}"
+
+    # Process-wide (ATen keeps one intra-op thread pool), so set once before any thread uses torch
+    if args.torch_num_threads > 0:
+        torch.set_num_threads(args.torch_num_threads)
+
+    if args.mpc_ensemble_size > 1:
+        assert not args.mpc_compiled_inference and args.mpc_inference_precision == "float32", \
+            f"{args.mpc_ensemble_size, args.mpc_compiled_inference, args.mpc_inference_precision}"
+
+    if args.mpc_inference_precision == "int8":
+        assert torch.device(args.device).type == "cpu", f"{args.mpc_inference_precision, args.device}"
+
     if args.environment in ["antmaze-umaze-v0", "antmaze-medium-play-v0", "antmaze-large-play-v0"]:
         env = gym.make(args.environment)
         # pick a goal state for the env
@@ -75,6 +159,39 @@ if __name__ == "__main__":
     else:
         raise NotImplementedError("Environment not supported!")
 
+    dynamics_schedule = DynamicsModelSchedule(args.dynamics_training_schedule, args.dynamics_gradient_steps,
+                                              args.dynamics_train_every, args.dynamics_recent_fraction,
+                                              args.dynamics_drift_error_ratio, args.dynamics_drift_state_shift,
+                                              args.dynamics_distill_steps if args.mpc_student_hidden_size > 0 else 0,
+                                              background=args.async_learning)
+
+    # Passed unchanged to every ModelBasedOption
+    option_kwargs = {
+            "mpc_planner": args.mpc_planner,
+            "mpc_num_rollouts": args.mpc_num_rollouts,
+            "mpc_warm_start_fraction": args.mpc_warm_start_fraction,
+            "mpc_compiled_inference": args.mpc_compiled_inference,
+            "mpc_ensemble_size": args.mpc_ensemble_size,
+            "mpc_inference_precision": args.mpc_inference_precision,
+            "mpc_student_hidden_size": args.mpc_student_hidden_size,
+            "mpc_student_rescore_top_k": args.mpc_student_rescore_top_k,
+            "mpc_planning_workers": args.mpc_planning_workers,
+            "mpc_adaptive_sampling": args.mpc_adaptive_sampling,
+            "mpc_sample_chunk_size": args.mpc_sample_chunk_size,
+            "action_chunk_size": args.action_chunk_size,
+            "replan_tolerance": args.replan_tolerance,
+            "speculative_planning": args.speculative_planning,
+            "value_gradient_steps": args.value_gradient_steps,
+            "td3_replay_storage": args.td3_replay_storage,
+            "td3_prefetch_batches": args.td3_prefetch_batches,
+            "td3_fused_critic": args.td3_fused_critic,
+            "td3_compile_update": args.td3_compile_update,
+            "td3_numpy_inference": args.td3_numpy_inference,
+            "async_value_learning": args.async_learning,
+            "value_update_to_data_ratio": args.value_update_to_data_ratio,
+            "value_publish_every": args.value_publish_every
+    }
+
     kwargs = {
             "mdp":env,
             "gestation_period": args.gestation_period,
@@ -88,6 +205,10 @@ if __name__ == "__main__":
             "use_diverse_starts": args.use_diverse_starts,
             "use_dense_rewards": args.use_dense_rewards,
             "multithread_mpc": args.multithread_mpc,
+            "dynamics_schedule": dynamics_schedule,
+            "option_kwargs": option_kwargs,
+            "global_action_chunk_size": args.global_action_chunk_size,
+            "shared_transition_store": args.shared_transition_store,
             "logging_freq": args.logging_frequency,
             "evaluation_freq": args.evaluation_frequency,
             "buffer_length": args.buffer_length,
@@ -1,6 +1,7 @@
 import random
 import itertools
 from copy import deepcopy
+from collections import deque
 
 import torch
 import numpy as np
@@ -9,13 +10,28 @@ from thundersvm import OneClassSVM, SVC
 
 from hrl.agent.dynamics.mpc import MPC
 from hrl.agent.td3.TD3AgentClass import TD3
+from hrl.agent.td3.replay_buffer import GoalRelabeledReplayBuffer
 
 
 class ModelBasedOption(object):
     def __init__(self, *, name, parent, mdp, global_solver, global_value_learner, buffer_length, global_init,
                  gestation_period, timeout, max_steps, device, use_vf, use_global_vf, use_model, dense_reward,
                  option_idx, lr_c, lr_a, max_num_children=1, init_salient_event=None, target_salient_event=None,
-                 path_to_model="", multithread_mpc=False):
+                 path_to_model="", multithread_mpc=False, mpc_planner="random", mpc_num_rollouts=None,
+                 mpc_warm_start_fraction=0.,
+                 mpc_compiled_inference=False,
+                 mpc_ensemble_size=1,
+                 mpc_inference_precision="float32",
+                 mpc_student_hidden_size=0,
+                 mpc_student_rescore_top_k=0,
+                 mpc_planning_workers=0,
+                 mpc_adaptive_sampling=False,
+                 mpc_sample_chunk_size=2048,
+                 action_chunk_size=1, replan_tolerance=0.5, speculative_planning=False,
+                 value_gradient_steps=0, transition_store=None, td3_replay_storage="numpy",
+                 td3_prefetch_batches=False, td3_fused_critic=False, td3_compile_update=False,
+                 td3_numpy_inference=False, async_value_learning=False, value_update_to_data_ratio=1.,
+                 value_publish_every=100):
         self.mdp = mdp
         self.name = name
         self.lr_c = lr_c
@@ -36,6 +52,53 @@ class ModelBasedOption(object):
         self.target_salient_event = target_salient_event
         self.multithread_mpc = multithread_mpc
 
+        # Settings of the option's `MPC`, documented in its constructor
+        self.mpc_planner = mpc_planner
+        self.mpc_num_rollouts = mpc_num_rollouts
+        self.mpc_warm_start_fraction = mpc_warm_start_fraction
+        self.mpc_ensemble_size = mpc_ensemble_size
+        self.mpc_compiled_inference = mpc_compiled_inference
+        self.mpc_inference_precision = mpc_inference_precision
+        self.mpc_student_hidden_size = mpc_student_hidden_size
+        self.mpc_student_rescore_top_k = mpc_student_rescore_top_k
+        self.mpc_planning_workers = mpc_planning_workers
+        self.mpc_adaptive_sampling = mpc_adaptive_sampling
+        self.mpc_sample_chunk_size = mpc_sample_chunk_size
+
+        # Open-loop execution: run the first `action_chunk_size` actions of every planned sequence and
+        # replan early if the observed position is further than `replan_tolerance` from the predicted one
+        self.action_chunk_size = action_chunk_size
+        self.replan_tolerance = replan_tolerance
+        self.num_planner_calls = 0  # plans whose actions were executed, since the start of the episode
+        self.reset_action_chunk()
+
+        # Speculative planning: plan for the next step from the model's predicted next state while the
+        # simulator steps, and keep that plan (and its warm start) if the observed state is within
+        # `replan_tolerance` of it; otherwise the warm start from before the speculation is restored
+        self.speculative_planning = speculative_planning
+        self.speculation = None
+        self.num_speculations = 0
+        self.num_speculation_hits = 0
+
+        # TD3 gradient steps after relabeling a rollout (0 = one per relabeled transition)
+        self.value_gradient_steps = value_gradient_steps
+
+        # Environment transitions shared by the dynamics model and all TD3 learners (None = separate buffers)
+        self.transition_store = transition_store
+
+        # Replay storage and update settings of the option's TD3 learners, documented in `TD3`
+        self.td3_replay_storage = td3_replay_storage
+        self.td3_prefetch_batches = td3_prefetch_batches
+        self.td3_fused_critic = td3_fused_critic
+        self.td3_compile_update = td3_compile_update
+        self.td3_numpy_inference = td3_numpy_inference
+
+        # Train the option's value learner on a background thread that takes `value_update_to_data_ratio`
+        # updates per relabeled transition and publishes its weights every `value_publish_every` updates
+        self.async_value_learning = async_value_learning
+        self.value_update_to_data_ratio = value_update_to_data_ratio
+        self.value_publish_every = value_publish_every
+
         # TODO
         self.overall_mdp = mdp
         self.seed = 0
@@ -62,7 +125,13 @@ class ModelBasedOption(object):
                                     name=f"{name}-td3-agent",
                                     device=self.device,
                                     lr_c=lr_c, lr_a=lr_a,
-                                    use_output_normalization=use_output_norm)
+                                    use_output_normalization=use_output_norm,
+                                    replay_buffer=self._get_relabeled_replay_buffer(),
+                                    replay_storage=self.td3_replay_storage,
+                                    prefetch_batches=self.td3_prefetch_batches,
+                                    fused_critic=self.td3_fused_critic,
+                                    compile_update=self.td3_compile_update,
+                                    numpy_inference=self.td3_numpy_inference)
 
         self.global_value_learner = global_value_learner if not self.global_init else None  # type: TD3
 
@@ -84,10 +153,21 @@ class ModelBasedOption(object):
         if self.use_vf and not self.use_global_vf and self.parent is not None:
             self.initialize_value_function_with_global_value_function()
 
+        if self.async_value_learning and self.use_vf and (not self.use_global_vf or global_init):
+            self.value_learner.start_async_learner(self.value_update_to_data_ratio, self.value_publish_every)
+
         print(f"Created model-based option {self.name} with option_idx={self.option_idx}")
 
         self.is_last_option = False
 
+    def _get_relabeled_replay_buffer(self):
+        if self.transition_store is None:
+            return None
+
+        reward_func = self.overall_mdp.dense_gc_reward_func if self.dense_reward \
+            else self.overall_mdp.sparse_gc_reward_func
+        return GoalRelabeledReplayBuffer(self.transition_store, reward_func, device=self.device)
+
     def _get_model_based_solver(self):
         assert self.use_model
 
@@ -97,7 +177,19 @@ class ModelBasedOption(object):
                        action_size=self.mdp.action_space_size(),
                        dense_reward=self.dense_reward,
                        device=self.device,
-                       multithread=self.multithread_mpc)
+                       multithread=self.multithread_mpc,
+                       planner=self.mpc_planner,
+                       num_rollouts=self.mpc_num_rollouts,
+                       warm_start_fraction=self.mpc_warm_start_fraction,
+                       compiled_inference=self.mpc_compiled_inference,
+                       ensemble_size=self.mpc_ensemble_size,
+                       inference_precision=self.mpc_inference_precision,
+                       student_hidden_size=self.mpc_student_hidden_size,
+                       student_rescore_top_k=self.mpc_student_rescore_top_k,
+                       planning_workers=self.mpc_planning_workers,
+                       adaptive_sampling=self.mpc_adaptive_sampling,
+                       sample_chunk_size=self.mpc_sample_chunk_size,
+                       replay_buffer=self.transition_store)
 
         assert self.global_solver is not None
         return self.global_solver
@@ -146,6 +238,11 @@ class ModelBasedOption(object):
         # TODO change
         return self.parent.pessimistic_is_init_true(state)
 
+    def batched_is_term_true(self, states):
+        if self.parent is None:
+            return self.target_salient_event(states[:, :2])
+        return self.parent.batched_pessimistic_is_init_true(states)
+
     def pessimistic_is_init_true(self, state):
         if self.global_init or self.get_training_phase() == "gestation":
             return True
@@ -153,6 +250,13 @@ class ModelBasedOption(object):
         features = self.mdp.extract_features_for_initiation_classifier(state)
         return self.pessimistic_classifier.predict([features])[0] == 1
 
+    def batched_pessimistic_is_init_true(self, states):
+        if self.global_init or self.get_training_phase() == "gestation":
+            return np.ones((states.shape[0],), dtype=bool)
+
+        features = np.array([self.mdp.extract_features_for_initiation_classifier(state) for state in states])
+        return self.pessimistic_classifier.predict(features) == 1
+
     def is_at_local_goal(self, state, goal):
         """ Goal-conditioned termination condition. """
 
@@ -180,16 +284,105 @@ class ModelBasedOption(object):
         if self.use_model:
             assert isinstance(self.solver, MPC), f"{type(self.solver)}"
             vf = self.value_function if self.use_vf else None
+            self.num_planner_calls += 1
             return self.solver.act(state, goal, vf=vf)
 
         assert isinstance(self.solver, TD3), f"{type(self.solver)}"
         augmented_state = self.get_augmented_state(state, goal)
         return self.solver.act(augmented_state, evaluation_mode=False)
 
+    def act_open_loop(self, state, goal):
+        """ Epsilon-greedy action selection that executes planned actions open loop, `action_chunk_size` at a time. """
+
+        if random.random() < self._get_epsilon():
+            # The exploratory action invalidates the predicted states of the rest of the chunk
+            self.planned_actions.clear()
+            action = self.mdp.action_space.sample()
+        else:
+            if len(self.planned_actions) == 0 or self.has_drifted_from_plan(state):
+                self.replan(state, goal)
+            action, self.expected_state = self.planned_actions.popleft()
+
+        self.steps_since_plan += 1
+        return action
+
+    def act_speculatively(self, state, goal):
+        """ Epsilon-greedy action selection that starts planning the next step before the environment is stepped. """
+
+        speculation = self.discard_speculation()
+        vf = self.value_function if self.use_vf else None
+
+        if random.random() < self._get_epsilon():
+            action = self.mdp.action_space.sample()
+        elif speculation is not None and self.is_close_to_prediction(state, speculation[0]):
+            predicted_state, future, speculative_plan_state = speculation
+            action = future.result()
+            self.solver.set_plan_state(speculative_plan_state)
+            self.num_speculation_hits += 1
+            self.num_planner_calls += 1
+        else:
+            action = self.solver.act(state, goal, vf=vf)
+            self.num_planner_calls += 1
+
+        # Plan the next step from where the model expects `action` to take us
+        predicted_state = self.solver.predict_next_state(state, action)
+        plan_state = self.solver.get_plan_state()
+        self.speculation = predicted_state, self.solver.act_async(predicted_state, goal, vf=vf), plan_state
+        self.num_speculations += 1
+
+        return action
+
+    def discard_speculation(self):
+        """ Stop tracking the running speculative plan (after it finishes), restore the warm start it overwrote
+        and return it as (predicted state, future, warm start saved by the speculative plan). """
+        speculation, self.speculation = self.speculation, None
+        if speculation is None:
+            return None
+
+        predicted_state, future, plan_state = speculation
+        future.result()  # the planner buffers are shared, so never plan concurrently
+
+        speculative_plan_state = self.solver.get_plan_state()
+        self.solver.set_plan_state(plan_state)
+        return predicted_state, future, speculative_plan_state
+
+    def is_close_to_prediction(self, state, predicted_state):
+        return np.linalg.norm(state[:2] - predicted_state[:2]) <= self.replan_tolerance
+
+    def replan(self, state, goal):
+        assert isinstance(self.solver, MPC), f"{type(self.solver)}"
+
+        # Keep the warm start aligned with the steps taken since the last plan
+        self.solver.advance_plan(self.steps_since_plan - 1)
+        self.steps_since_plan = 0
+
+        vf = self.value_function if self.use_vf else None
+        actions, predicted_states = self.solver.act_sequence(state, goal, vf=vf)
+        self.planned_actions = deque(zip(actions[:self.action_chunk_size], predicted_states[:self.action_chunk_size]))
+        self.num_planner_calls += 1
+
+    def has_drifted_from_plan(self, state):
+        if self.expected_state is None:
+            return False
+        return not self.is_close_to_prediction(state, self.expected_state)
+
+    def reset_action_chunk(self):
+        self.planned_actions = deque()
+        self.expected_state = None
+        self.steps_since_plan = 0
+
     def update_model(self, state, action, reward, next_state, next_done):
-        """ Learning update for option model/actor/critic. """
+        """ Learning update for option model/actor/critic. Returns the id of the stored transition. """
+
+        return self.solver.step(state, action, reward, next_state, next_done)
 
-        self.solver.step(state, action, reward, next_state, next_done)
+    def store_transition(self, state, action, reward, next_state, next_done):
+        """ Id of the transition in the shared transition store (None if there is none). """
+
+        if self.use_model:
+            return self.update_model(state, action, reward, next_state, next_done)
+        if self.transition_store is not None:
+            return self.transition_store.store(state, action, reward, next_state, next_done)
 
     def get_goal_for_rollout(self):
         """ Sample goal to pursue for option rollout. """
@@ -215,6 +408,7 @@ class ModelBasedOption(object):
         total_reward = 0
         visited_states = []
         option_transitions = []
+        transition_ids = []
 
         state = deepcopy(self.mdp.cur_state)
         goal = self.get_goal_for_rollout() if rollout_goal is None else rollout_goal
@@ -223,14 +417,26 @@ class ModelBasedOption(object):
 
         self.num_executions += 1
 
+        # The shared planner should not warm start from another option's (or goal's) plan
+        if self.use_model:
+            self.solver.reset_plan()
+            self.reset_action_chunk()
+
+        open_loop = self.use_model and self.action_chunk_size > 1
+        speculative = self.use_model and self.speculative_planning and not open_loop
+
         while not self.is_at_local_goal(state, goal) and step_number < self.max_steps and num_steps < self.timeout:
 
             # Control
-            action = self.act(state, goal)
+            if open_loop:
+                action = self.act_open_loop(state, goal)
+            elif speculative:
+                action = self.act_speculatively(state, goal)
+            else:
+                action = self.act(state, goal)
             next_state, reward, next_done, _ = self.mdp.step(action)
 
-            if self.use_model:
-                self.update_model(state, action, reward, next_state, next_done)
+            transition_id = self.store_transition(state, action, reward, next_state, next_done)
 
             # Logging
             num_steps += 1
@@ -238,8 +444,13 @@ class ModelBasedOption(object):
             total_reward += reward
             visited_states.append(state)
             option_transitions.append((state, action, reward, next_state, next_done))
+            transition_ids.append(transition_id)
             state = deepcopy(self.mdp.cur_state)
 
+        # The plan speculated for the step after termination is never used
+        if speculative:
+            self.discard_speculation()
+
         visited_states.append(state)
         reached_term = self.is_term_true(state)
         self.success_curve.append(reached_term)
@@ -251,7 +462,8 @@ class ModelBasedOption(object):
         if self.use_vf and not eval_mode:
             self.update_value_function(option_transitions,
                                     pursued_goal=goal,
-                                    reached_goal=self.extract_goal_dimensions(state))
+                                    reached_goal=self.extract_goal_dimensions(state),
+                                    transition_ids=transition_ids)
 
         is_valid_data = self.max_num_children == 1 or self.is_valid_init_data(state_buffer=visited_states)
         init_update_condition = (self.is_term_true(state) and is_valid_data) or not self.is_term_true(state)
@@ -269,11 +481,10 @@ class ModelBasedOption(object):
     # Hindsight Experience Replay
     # ------------------------------------------------------------
 
-    def update_value_function(self, option_transitions, reached_goal, pursued_goal):
+    def update_value_function(self, option_transitions, reached_goal, pursued_goal, transition_ids=None):
         """ Update the goal-conditioned option value function. """
 
-        self.experience_replay(option_transitions, pursued_goal)
-        self.experience_replay(option_transitions, reached_goal)
+        self.experience_replay(option_transitions, [pursued_goal, reached_goal], transition_ids)
 
     def initialize_value_function_with_global_value_function(self):
         self.value_learner.actor.load_state_dict(self.global_value_learner.actor.state_dict())
@@ -294,23 +505,60 @@ class ModelBasedOption(object):
         goal_position = self.extract_goal_dimensions(goal)
         return np.concatenate((state, goal_position))
 
-    def experience_replay(self, trajectory, goal_state):
-        for state, action, reward, next_state, next_done in trajectory:
-            augmented_state = self.get_augmented_state(state, goal=goal_state)
-            augmented_next_state = self.get_augmented_state(next_state, goal=goal_state)
-            done = self.is_at_local_goal(next_state, goal_state)
+    def experience_replay(self, trajectory, goals, transition_ids=None):
+        """ Relabel the whole `trajectory` with each of `goals` at once, bulk insert the relabeled
+        transitions into the TD3 replay buffer(s) and then take `value_gradient_steps` updates.
+        With a shared transition store only the `transition_ids` of the trajectory are inserted,
+        together with the goals; the learners relabel the rewards when they sample them. """
 
-            reward_func = self.overall_mdp.dense_gc_reward_func if self.dense_reward \
-                else self.overall_mdp.sparse_gc_reward_func
-            reward, global_done = reward_func(next_state, goal_state)
+        if len(trajectory) == 0:
+            return
 
-            if not self.use_global_vf or self.global_init:
-                self.value_learner.step(augmented_state, action, reward, augmented_next_state, done)
+        states, actions, _, next_states, _ = map(np.array, zip(*trajectory))
+        goal_positions = np.array([self.extract_goal_dimensions(goal) for goal in goals])
 
-            # Off-policy updates to the global option value function
-            if not self.global_init:
-                assert self.global_value_learner is not None
-                self.global_value_learner.step(augmented_state, action, reward, augmented_next_state, global_done)
+        # Goal-major order: the whole trajectory relabeled with the first goal, then with the second, ...
+        num_goals = goal_positions.shape[0]
+        relabeled_goals = np.repeat(goal_positions, len(trajectory), axis=0)
+        relabeled_next_states = np.tile(next_states, (num_goals, 1))
+
+        reward_func = self.overall_mdp.dense_gc_reward_func if self.dense_reward \
+            else self.overall_mdp.sparse_gc_reward_func
+        rewards, global_dones = reward_func(relabeled_next_states, relabeled_goals, batched=True)
+
+        # `is_at_local_goal`: the goal is reached and the option's termination condition holds
+        reached_term = self.batched_is_term_true(next_states)
+        dones = np.logical_and(global_dones, np.tile(reached_term, num_goals))
+
+        if self.transition_store is not None:
+            assert transition_ids is not None and len(transition_ids) == len(trajectory)
+            relabeled_ids = np.tile(transition_ids, num_goals)
+
+            # The relabeled buffers need the entries in order of their ids, i.e, transition-major
+            order = np.argsort(relabeled_ids, kind="stable")
+
+            def add_transitions(learner, is_terminals):
+                learner.add_relabeled_transitions(relabeled_ids[order], relabeled_goals[order], is_terminals[order])
+        else:
+            relabeled_states = np.tile(states, (num_goals, 1))
+            relabeled_actions = np.tile(actions, (num_goals, 1))
+            augmented_states = np.concatenate((relabeled_states, relabeled_goals), axis=1)
+            augmented_next_states = np.concatenate((relabeled_next_states, relabeled_goals), axis=1)
+
+            def add_transitions(learner, is_terminals):
+                learner.add_transitions(augmented_states, relabeled_actions, rewards, augmented_next_states, is_terminals)
+
+        num_gradient_steps = self.value_gradient_steps if self.value_gradient_steps > 0 else len(rewards)
+
+        if not self.use_global_vf or self.global_init:
+            add_transitions(self.value_learner, dones)
+            self.value_learner.train_steps(num_gradient_steps)
+
+        # Off-policy updates to the global option value function
+        if not self.global_init:
+            assert self.global_value_learner is not None
+            add_transitions(self.global_value_learner, global_dones)
+            self.global_value_learner.train_steps(num_gradient_steps)
 
     def value_function(self, states, goals):
         assert isinstance(states, np.ndarray)
@@ -413,16 +661,20 @@ class ModelBasedOption(object):
             self.negative_examples.append(negative_examples)
 
     def should_change_negative_examples(self):
-        should_change = []
-        for negative_example in self.negative_examples:
-            should_change += [self.does_model_rollout_reach_goal(negative_example[0])]
-        return should_change
+        if len(self.negative_examples) == 0:
+            return []
+
+        # Simulate from all the negative examples in one batched sweep through the model
+        states = np.array([negative_example[0] for negative_example in self.negative_examples])
+        goals = np.array([self.get_goal_for_rollout()[:2] for _ in self.negative_examples])
+        farthest_positions, _, _ = self.solver.simulate_many(states, goals, num_rollouts=14000, num_steps=self.timeout)
+        return [self.is_term_true(farthest_position) for farthest_position in farthest_positions]
 
     def does_model_rollout_reach_goal(self, state):
         sampled_goal = self.get_goal_for_rollout()
-        final_states, actions, costs = self.solver.simulate(state, sampled_goal, num_rollouts=14000, num_steps=self.timeout)
-        farthest_position = final_states[:, :2].max(axis=0)
-        return self.is_term_true(farthest_position)
+        farthest_positions, _, _ = self.solver.simulate_many(state[None, ...], sampled_goal[None, :2],
+                                                             num_rollouts=14000, num_steps=self.timeout)
+        return self.is_term_true(farthest_positions[0])
 
     def fit_initiation_classifier(self):
         if len(self.negative_examples) > 0 and len(self.positive_examples) > 0:
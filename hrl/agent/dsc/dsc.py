@@ -7,13 +7,16 @@ import numpy as np
 
 from hrl.agent.dsc.utils import *
 from hrl.agent.dsc.MBOptionClass import ModelBasedOption
+from hrl.agent.dynamics.replay_buffer import ReplayBuffer
 
 
 class RobustDSC(object):
     def __init__(self, mdp, warmup_episodes, max_steps, gestation_period, buffer_length, use_vf, use_global_vf, use_model,
                  use_diverse_starts, use_dense_rewards, lr_c, lr_a,
                  experiment_name, device,
-                 logging_freq, generate_init_gif, evaluation_freq, seed, multithread_mpc):
+                 logging_freq, generate_init_gif, evaluation_freq, seed, multithread_mpc,
+                 dynamics_schedule=None, option_kwargs=None,
+                 global_action_chunk_size=0, shared_transition_store=False):
 
         self.lr_c = lr_c
         self.lr_a = lr_a
@@ -29,6 +32,15 @@ class RobustDSC(object):
         self.use_dense_rewards = use_dense_rewards
         self.multithread_mpc = multithread_mpc
 
+        # When and how much the dynamics model is trained after every episode, see `DynamicsModelSchedule`
+        self.dynamics_schedule = dynamics_schedule if dynamics_schedule is not None else DynamicsModelSchedule()
+
+        # Planner, action execution and value learner settings passed unchanged to every `ModelBasedOption`;
+        # the global option may execute a different number of planned actions per planner call (0 = the same)
+        self.option_kwargs = option_kwargs if option_kwargs is not None else {}
+        self.global_option_kwargs = dict(self.option_kwargs, action_chunk_size=global_action_chunk_size) \
+                                    if global_action_chunk_size > 0 else self.option_kwargs
+
         self.seed = seed
         self.logging_freq = logging_freq
         self.evaluation_freq = evaluation_freq
@@ -40,6 +52,10 @@ class RobustDSC(object):
         self.mdp = mdp
         self.target_salient_event = self.mdp.get_original_target_events()[0]
 
+        self.transition_store = ReplayBuffer(obs_dim=self.mdp.state_space_size(),
+                                             act_dim=self.mdp.action_space_size(),
+                                             size=int(3e5)) if shared_transition_store else None
+
         self.global_option = self.create_global_model_based_option()
         self.goal_option = self.create_model_based_option(name="goal-option", parent=None)
 
@@ -103,6 +119,9 @@ class RobustDSC(object):
         for episode in range(start_episode, start_episode + num_episodes):
             self.reset(episode)
 
+            if self.dynamics_schedule.background and self.use_model:
+                self.global_option.solver.finish_background_training()
+
             step = self.dsc_rollout(num_steps) if episode > self.warmup_episodes else self.random_rollout(num_steps)
 
             last_10_durations.append(step)
@@ -111,8 +130,12 @@ class RobustDSC(object):
 
             if episode == self.warmup_episodes - 1 and self.use_model:
                 self.learn_dynamics_model(epochs=50)
-            elif episode >= self.warmup_episodes and self.use_model:
-                self.learn_dynamics_model(epochs=5)
+            elif episode >= self.warmup_episodes and self.use_model and \
+                    self.dynamics_schedule.should_train(self.global_option.solver):
+                if self.dynamics_schedule.training_schedule == "fixed_steps":
+                    self.learn_dynamics_model(num_gradient_steps=self.dynamics_schedule.get_num_gradient_steps(step))
+                else:
+                    self.learn_dynamics_model(epochs=5)
 
             self.log_success_metrics(episode)
 
@@ -123,6 +146,9 @@ class RobustDSC(object):
         overall_success = reduce(lambda x,y: x*y, individual_option_data.values())
         self.log[episode] = {"individual_option_data": individual_option_data, "success_rate": overall_success}
 
+        if self.use_model:
+            self.log[episode]["planner_calls"] = self.get_planner_calls()
+
         if episode % self.evaluation_freq == 0 and episode > self.warmup_episodes:
             success, step_count = test_agent(self, 1, self.max_steps)
 
@@ -132,11 +158,10 @@ class RobustDSC(object):
             with open(f"results/{self.experiment_name}/log_file_{self.seed}.pkl", "wb+") as log_file:
                 pickle.dump(self.log, log_file)
 
-    def learn_dynamics_model(self, epochs=50, batch_size=1024):
-        self.global_option.solver.load_data()
-        self.global_option.solver.train(epochs=epochs, batch_size=batch_size)
-        for option in self.chain:
-            option.solver.model = self.global_option.solver.model
+    def learn_dynamics_model(self, epochs=50, batch_size=1024, num_gradient_steps=None):
+        if self.dynamics_schedule.train(self.global_option.solver, epochs, batch_size, num_gradient_steps):
+            for option in self.chain:
+                option.solver.model = self.global_option.solver.model
 
     def is_chain_complete(self):
         return all([option.get_training_phase() == "initiation_done" for option in self.chain]) and self.mature_options[-1].is_init_true(np.array([0,0]))
@@ -181,6 +206,9 @@ class RobustDSC(object):
     def log_status(self, episode, last_10_durations):
         print(f"Episode {episode} \t Mean Duration: {np.mean(last_10_durations)}")
 
+        if self.use_model:
+            print(f"Episode {episode} \t Planner calls (calls, action chunk size): {self.get_planner_calls()}")
+
         if episode % self.logging_freq == 0 and episode != 0:
             options = self.mature_options + self.new_options
 
@@ -219,7 +247,9 @@ class RobustDSC(object):
                                   global_value_learner=self.global_option.value_learner,
                                   option_idx=option_idx,
                                   lr_c=self.lr_c, lr_a=self.lr_a,
-                                  multithread_mpc=self.multithread_mpc)
+                                  multithread_mpc=self.multithread_mpc,
+                                  transition_store=self.transition_store,
+                                  **self.option_kwargs)
         return option
 
     def create_global_model_based_option(self):  # TODO: what should the timeout be for this option?
@@ -239,12 +269,22 @@ class RobustDSC(object):
                                   global_value_learner=None,
                                   option_idx=0,
                                   lr_c=self.lr_c, lr_a=self.lr_a,
-                                  multithread_mpc=self.multithread_mpc)
+                                  multithread_mpc=self.multithread_mpc,
+                                  transition_store=self.transition_store,
+                                  **self.global_option_kwargs)
         return option
 
+    def get_planner_calls(self):
+        """ Planner calls made by every option this episode, with the action chunk size it executes plans at. """
+        options = [self.global_option] + self.chain
+        return {option.name: (option.num_planner_calls, option.action_chunk_size) for option in options}
+
     def reset(self, episode):
         self.mdp.reset()
 
+        for option in [self.global_option] + self.chain:
+            option.num_planner_calls = 0
+
         if self.use_diverse_starts and episode > self.warmup_episodes:
             random_state = self.mdp.sample_random_state()
             random_position = self.mdp.get_position(random_state)
@@ -10,6 +10,7 @@ from collections import deque
 
 from hrl.agent.dsc.utils import *
 from hrl.agent.dsc.MBOptionClass import ModelBasedOption
+from hrl.agent.dynamics.replay_buffer import ReplayBuffer
 
 
 class RobustDST(object):
@@ -17,7 +18,8 @@ class RobustDST(object):
                  use_vf, use_global_vf, use_model, lr_a, lr_c,
                  max_steps, use_diverse_starts, use_dense_rewards, experiment_name,
                  logging_freq, evaluation_freq, device, seed, multithread_mpc,
-                 generate_init_gif, max_num_children):
+                 generate_init_gif, max_num_children, dynamics_schedule=None, option_kwargs=None,
+                 global_action_chunk_size=0, shared_transition_store=False):
         self.seed = seed
         self.device = device
         self.use_vf = use_vf
@@ -33,6 +35,16 @@ class RobustDST(object):
         self.use_dense_rewards = use_dense_rewards
         self.generate_init_gif = generate_init_gif
         self.max_num_children = max_num_children
+        self.multithread_mpc = multithread_mpc
+
+        # When and how much the dynamics model is trained after every episode, see `DynamicsModelSchedule`
+        self.dynamics_schedule = dynamics_schedule if dynamics_schedule is not None else DynamicsModelSchedule()
+
+        # Planner, action execution and value learner settings passed unchanged to every `ModelBasedOption`;
+        # the global option may execute a different number of planned actions per planner call (0 = the same)
+        self.option_kwargs = option_kwargs if option_kwargs is not None else {}
+        self.global_option_kwargs = dict(self.option_kwargs, action_chunk_size=global_action_chunk_size) \
+                                    if global_action_chunk_size > 0 else self.option_kwargs
 
         self.gestation_period = gestation_period
 
@@ -43,6 +55,10 @@ class RobustDST(object):
         self.init_salient_event = self.mdp.get_start_state_salient_event()
         self.target_salient_event = self.mdp.get_original_target_events()[0]
 
+        self.transition_store = ReplayBuffer(obs_dim=self.mdp.state_space_size(),
+                                             act_dim=self.mdp.action_space_size(),
+                                             size=int(3e5)) if shared_transition_store else None
+
         self.global_option = self.create_global_model_based_option()
         self.goal_option = self.create_model_based_option(name="goal-option", parent=None)
 
@@ -139,6 +155,9 @@ class RobustDST(object):
         for episode in range(start_episode, start_episode + num_episodes):
             self.reset(episode)
 
+            if self.dynamics_schedule.background and self.use_model:
+                self.global_option.solver.finish_background_training()
+
             step = self.dsc_rollout(num_steps) if episode > self.warmup_episodes else self.random_rollout(num_steps)
 
             last_10_durations.append(step)
@@ -147,18 +166,21 @@ class RobustDST(object):
 
             if episode == self.warmup_episodes - 1 and self.use_model:
                 self.learn_dynamics_model(epochs=50)
-            elif episode >= self.warmup_episodes and self.use_model:
-                self.learn_dynamics_model(epochs=5)
+            elif episode >= self.warmup_episodes and self.use_model and \
+                    self.dynamics_schedule.should_train(self.global_option.solver):
+                if self.dynamics_schedule.training_schedule == "fixed_steps":
+                    self.learn_dynamics_model(num_gradient_steps=self.dynamics_schedule.get_num_gradient_steps(step))
+                else:
+                    self.learn_dynamics_model(epochs=5)
 
             self.log_success_metrics(episode)
 
         return per_episode_durations
 
-    def learn_dynamics_model(self, epochs):
-        self.global_option.solver.load_data()
-        self.global_option.solver.train(epochs=epochs, batch_size=1024)
-        for option in self.skill_tree.options:
-            option.solver.model = self.global_option.solver.model
+    def learn_dynamics_model(self, epochs=50, num_gradient_steps=None):
+        if self.dynamics_schedule.train(self.global_option.solver, epochs, 1024, num_gradient_steps):
+            for option in self.skill_tree.options:
+                option.solver.model = self.global_option.solver.model
 
     def should_create_child_option(self, parent_option):
         assert isinstance(parent_option, ModelBasedOption)
@@ -224,6 +246,9 @@ class RobustDST(object):
         overall_success = reduce(lambda x,y: x*y, individual_option_data.values())
         self.log[episode] = {"individual_option_data": individual_option_data, "success_rate": overall_success}
 
+        if self.use_model:
+            self.log[episode]["planner_calls"] = self.get_planner_calls()
+
         if episode % self.evaluation_freq == 0 and episode > self.warmup_episodes:
             success, step_count, _ = test_agent(self, 1, self.max_steps, get_trajectories=False)
 
@@ -236,6 +261,9 @@ class RobustDST(object):
     def log_status(self, episode, last_10_durations):
         print(f"Episode {episode} \t Mean Duration: {np.mean(last_10_durations)}")
 
+        if self.use_model:
+            print(f"Episode {episode} \t Planner calls (calls, action chunk size): {self.get_planner_calls()}")
+
         if episode % self.logging_freq == 0 and episode != 0:
             options = self.mature_options + self.new_options
 
@@ -275,7 +303,10 @@ class RobustDST(object):
                                   use_global_vf=self.use_global_vf,
                                   lr_c=self.lr_c, lr_a=self.lr_a,
                                   option_idx=option_idx,
-                                  max_num_children=self.max_num_children)
+                                  max_num_children=self.max_num_children,
+                                  multithread_mpc=self.multithread_mpc,
+                                  transition_store=self.transition_store,
+                                  **self.option_kwargs)
         return option
 
     def create_global_model_based_option(self):  # TODO: what should the timeout be for this option?
@@ -296,12 +327,23 @@ class RobustDST(object):
                                   use_global_vf=self.use_global_vf,
                                   lr_c=self.lr_c, lr_a=self.lr_a,
                                   option_idx=0,
-                                  max_num_children=self.max_num_children)
+                                  max_num_children=self.max_num_children,
+                                  multithread_mpc=self.multithread_mpc,
+                                  transition_store=self.transition_store,
+                                  **self.global_option_kwargs)
         return option
 
+    def get_planner_calls(self):
+        """ Planner calls made by every option this episode, with the action chunk size it executes plans at. """
+        options = [self.global_option] + self.mature_options + self.new_options
+        return {option.name: (option.num_planner_calls, option.action_chunk_size) for option in options}
+
     def reset(self, episode):
         self.mdp.reset()
 
+        for option in [self.global_option] + self.mature_options + self.new_options:
+            option.num_planner_calls = 0
+
         if self.use_diverse_starts and episode > self.warmup_episodes:
             random_state = self.mdp.sample_random_state()
             random_position = self.mdp.get_position(random_state)
@@ -42,6 +42,72 @@ class SkillTree(object):
         self._tree.show()
 
 
+class DynamicsModelSchedule(object):
+    """
+    When and how much the dynamics model of the global option's MPC is trained after an episode.
+
+    `training_schedule` "epochs": a few passes over the whole buffer after every episode, or "fixed_steps":
+    `gradient_steps` per episode (per `train_every` env steps if > 0), drawing `recent_fraction` of every
+    minibatch from the newest transitions.
+
+    Drift-triggered retraining: after warmup, only train the model when its streaming one-step error exceeds
+    `drift_error_ratio` times its training error, or the visited states shifted by `drift_state_shift` std
+    (see `MPC.needs_retraining`). 0 disables it.
+
+    Every training pass is followed by `distill_steps` of student distillation (0 = no student). With
+    `background`, a model is trained on a background thread once there is one to plan with in the meantime.
+    """
+    def __init__(self, training_schedule="epochs", gradient_steps=500, train_every=0, recent_fraction=0.5,
+                 drift_error_ratio=0., drift_state_shift=1., distill_steps=0, background=False):
+        assert training_schedule in ("epochs", "fixed_steps"), training_schedule
+        self.training_schedule = training_schedule
+        self.gradient_steps = gradient_steps
+        self.train_every = train_every
+        self.recent_fraction = recent_fraction
+        self.drift_error_ratio = drift_error_ratio
+        self.drift_state_shift = drift_state_shift
+        self.distill_steps = distill_steps
+        self.background = background
+        self.num_skipped_updates = 0
+
+    def should_train(self, solver):
+        if self.drift_error_ratio <= 0:
+            return True
+
+        if solver.needs_retraining(self.drift_error_ratio, self.drift_state_shift):
+            return True
+
+        self.num_skipped_updates += 1
+        print(f"Skipping dynamics model update #{self.num_skipped_updates}, "
+              f"one-step error {solver.prediction_error} (trained: {solver.reference_error})")
+        return False
+
+    def get_num_gradient_steps(self, num_env_steps):
+        if self.train_every > 0:
+            return self.gradient_steps * int(np.ceil(num_env_steps / self.train_every))
+        return self.gradient_steps
+
+    def train(self, solver, epochs=50, batch_size=1024, num_gradient_steps=None):
+        """ Train `solver`'s model for `epochs` (or `num_gradient_steps`); returns whether it was replaced
+        right away, rather than trained in the background (see `MPC.finish_background_training`). """
+        if self.background and solver.is_trained:
+            # Start training the next model, unless the previous one is still training
+            solver.finish_background_training()
+            if solver.background_training is None:
+                solver.start_background_training(epochs, num_gradient_steps, batch_size,
+                                                 self.recent_fraction, self.distill_steps)
+            return False
+
+        solver.load_data()
+        if num_gradient_steps is None:
+            solver.train(epochs=epochs, batch_size=batch_size)
+        else:
+            solver.train_steps(num_gradient_steps, batch_size=batch_size, recent_fraction=self.recent_fraction)
+        if self.distill_steps > 0:
+            solver.distill(num_gradient_steps=self.distill_steps)
+        return True
+
+
 def make_meshgrid(x, y, h=.02):
     x_min, x_max = x.min() - 1, x.max() + 1
     y_min, y_max = y.min() - 1, y.max() + 1
@@ -152,11 +218,8 @@ def make_chunked_goal_conditioned_value_function_plot(solver, goal, episode, see
     goal = goal[:2]  # Extracting the position from the goal vector
 
     # Take out the original goal and append the new goal
-    states = [exp[0] for exp in replay_buffer]
-    states = [state[:-2] for state in states]
-    states = np.array([np.concatenate((state, goal), axis=0) for state in states])
-
-    actions = np.array([exp[1] for exp in replay_buffer])
+    states, actions = replay_buffer.get_states_actions()
+    states = np.concatenate((states[:, :-2], np.tile(goal, (len(states), 1))), axis=1)
 
     # Chunk up the inputs so as to conserve GPU memory
     num_chunks = int(np.ceil(states.shape[0] / chunk_size))
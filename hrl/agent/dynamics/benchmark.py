@@ -0,0 +1,220 @@
+"""
+Planning throughput of the different dynamics model inference paths, e.g,
+
+    python -m hrl.agent.dynamics.benchmark --device cpu --num_rollouts 14000 --num_steps 7
+
+Every mode is checked against the eager float32 `DynamicsModel` before it is timed: the
+largest one-step deviation and the largest deviation of the final states of the full rollouts.
+The "bfloat16" and "int8" modes are the reduced-precision planning models (`--mpc_inference_precision`).
+
+With `--num_workers 1 2 4 8 16 32` it also reports the latency of one planning call (all rollouts, all
+steps) when the population is sharded across that many planning threads (`--multithread_mpc`).
+
+With `--planners random cem mppi --environment antmaze-umaze-v0` (needs gym and d4rl) it compares the
+planners (`--mpc_planner`) at their default population sizes: rollouts simulated per action, latency of
+one `MPC.act` and the mean (dense) cost of the chosen action sequences under the model.
+"""
+import time
+import pickle
+import argparse
+
+import torch
+import numpy as np
+
+from hrl.agent.dynamics.dynamics_model import DynamicsModel
+from hrl.agent.dynamics.dynamics_model import CompiledDynamicsModel, max_prediction_error
+from hrl.agent.dynamics.parallel import ShardedRolloutExecutor
+
+
+def make_model(state_size, action_size, device, model_path=""):
+    """ Load a model saved with `MPC.save_model`, or make a random one with plausible statistics. """
+    model = DynamicsModel(state_size, action_size, device)
+
+    if model_path:
+        with open(model_path, "rb") as f:
+            model.__setstate__(pickle.load(f))
+    else:
+        model.set_standardization_vars(np.random.randn(state_size).astype(np.float32),
+                                       np.zeros(action_size, dtype=np.float32),
+                                       np.zeros(state_size, dtype=np.float32),
+                                       np.random.uniform(0.5, 2., state_size).astype(np.float32),
+                                       np.ones(action_size, dtype=np.float32) * 0.58,
+                                       np.random.uniform(0.01, 0.1, state_size).astype(np.float32))
+
+    return model.to(device)
+
+
+def get_planning_models(model, modes):
+    builders = {
+        "eager": lambda: model,
+        "folded": lambda: CompiledDynamicsModel(model, backend="none"),
+        "torchscript": lambda: CompiledDynamicsModel(model, backend="torchscript"),
+        "compile": lambda: CompiledDynamicsModel(model, backend="compile"),
+        "bfloat16": lambda: CompiledDynamicsModel(model, backend="torchscript", precision="bfloat16"),
+        "int8": lambda: CompiledDynamicsModel(model, backend="torchscript", precision="int8"),
+    }
+    return {mode: builders[mode]() for mode in modes}
+
+
+def rollout_error(reference, candidate, states, actions):
+    """ Largest absolute difference between the final states of two models' rollouts of `actions`. """
+    expected, predicted = states, states
+    with torch.no_grad():
+        for j in range(actions.shape[1]):
+            expected = reference.predict_next_state(expected, actions[:, j, :])
+            predicted = candidate.predict_next_state(predicted, actions[:, j, :])
+    return (expected.float() - predicted.float()).abs().max().item()
+
+
+def time_planning(model, states, actions, repeats):
+    """ Planning steps (one batched model step for every rollout) per second. """
+    num_steps = actions.shape[1]
+
+    def plan():
+        next_states = states
+        for j in range(num_steps):
+            next_states = model.predict_next_state(next_states, actions[:, j, :])
+        return next_states
+
+    with torch.no_grad():
+        plan()  # warm up lazy initialization / compilation
+
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            plan()
+        elapsed = time.perf_counter() - start_time
+
+    return repeats * num_steps / elapsed
+
+
+def rollout_shard(states, goals, num_steps, actions, workspace, model):
+    with torch.no_grad():
+        for j in range(num_steps):
+            states = model.predict_next_state(states, actions[:, j, :])
+    return (states,)
+
+
+def time_sharded_planning(model, states, actions, num_workers, repeats):
+    """ Seconds per planning call with the rollouts split across `num_workers` threads. """
+    executor = ShardedRolloutExecutor(num_workers)
+    goals = torch.zeros((states.shape[0], 2), device=states.device)
+
+    def plan():
+        return executor.run(rollout_shard, states, goals, actions.shape[1], actions, model=model)
+
+    plan()  # warm up the worker threads
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        plan()
+    elapsed = time.perf_counter() - start_time
+
+    executor.shutdown()
+    return elapsed / repeats
+
+
+def make_mdp(environment):
+    """ The goal-conditioned wrapper of a D4RL antmaze, as in `hrl.__main__` (needs gym and d4rl). """
+    import gym
+    import d4rl  # registers the antmaze environments
+    from hrl.wrappers.antmaze_wrapper import D4RLAntMazeWrapper
+
+    env = gym.make(environment)
+    return D4RLAntMazeWrapper(env, start_state=np.array((0, 0)), goal_state=np.array(env.target_goal),
+                              use_dense_reward=True)
+
+
+def time_planner(mpc, states, goals, num_steps):
+    """ Seconds per action and mean cost (under the planning model) of the chosen action sequences. """
+    mpc.act_sequence(states[0], goals[0], num_steps=num_steps)  # warm up the workspace
+
+    elapsed, costs = 0., []
+    for state, goal in zip(states, goals):
+        mpc.reset_plan()
+
+        start_time = time.perf_counter()
+        plan, _ = mpc.act_sequence(state, goal, num_steps=num_steps)
+        elapsed += time.perf_counter() - start_time
+
+        torch_state = torch.as_tensor(state, device=mpc.device).float()[None, :]
+        torch_goal = torch.as_tensor(goal[:2], device=mpc.device).float()[None, :]
+        torch_plan = torch.as_tensor(plan, device=mpc.device)[None, ...]
+        _, _, cost = mpc._fused_rollout(torch_state, torch_goal, num_steps, torch_plan)
+        costs.append(cost.item())
+
+    return elapsed / len(states), np.mean(costs)
+
+
+def run_planner_benchmark(args, model, mdp):
+    from hrl.agent.dynamics.mpc import MPC  # needs gym, unlike the model benchmarks
+
+    device = torch.device(args.device)
+
+    states = (model.mean_x + model.std_x * torch.randn((args.num_decisions, args.state_size), device=device)).cpu().numpy()
+    goals = states[:, :2] + np.random.uniform(-4., 4., size=(args.num_decisions, 2))
+
+    print(f"\n{'planner':>8} | {'population':>10} | {'rollouts/act':>12} | {'latency (ms)':>12} | {'plan cost':>9}")
+    for planner in args.planners:
+        mpc = MPC(mdp, args.state_size, args.action_size, dense_reward=True, device=device, planner=planner)
+        mpc.model = model
+        mpc.is_trained = True
+
+        num_iterations = 1 if planner == "random" else mpc.planner_iterations
+        latency, cost = time_planner(mpc, states, goals, args.num_steps)
+        print(f"{planner:>8} | {mpc.num_rollouts:>10} | {num_iterations * mpc.num_rollouts:>12} | "
+              f"{1000 * latency:>12.1f} | {cost:>9.3f}")
+
+
+def run_benchmark(args):
+    device = torch.device(args.device)
+    model = make_model(args.state_size, args.action_size, device, args.model_path)
+
+    states = model.mean_x + model.std_x * torch.randn((args.num_rollouts, args.state_size), device=device)
+    actions = 2 * torch.rand((args.num_rollouts, args.num_steps, args.action_size), device=device) - 1
+
+    print(f"{'mode':>12} | {'1-step err':>10} | {'H-step err':>10} | {'model steps/s':>13} | {'mpc calls/s':>11}")
+    for mode, planning_model in get_planning_models(model, args.modes).items():
+        error = max_prediction_error(model, planning_model, states, actions[:, 0, :])
+        final_error = rollout_error(model, planning_model, states, actions)
+        steps_per_second = time_planning(planning_model, states, actions, args.repeats)
+        print(f"{mode:>12} | {error:>10.2e} | {final_error:>10.2e} | {steps_per_second:>13.1f} | {steps_per_second / args.num_steps:>11.2f}")
+
+    if args.num_workers:
+        planning_model = get_planning_models(model, args.modes[-1:])[args.modes[-1]]
+        print(f"\nSharded planning with the {args.modes[-1]} model, {torch.get_num_threads()} torch thread(s) in the process")
+        print(f"{'workers':>8} | {'latency (ms)':>12} | {'speedup':>7}")
+
+        base_latency = None
+        for num_workers in args.num_workers:
+            latency = time_sharded_planning(planning_model, states, actions, num_workers, args.repeats)
+            base_latency = latency if base_latency is None else base_latency
+            print(f"{num_workers:>8} | {1000 * latency:>12.1f} | {base_latency / latency:>7.2f}")
+
+    if args.planners:
+        run_planner_benchmark(args, model, make_mdp(args.environment))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--model_path", type=str, default="", help="pickle written by MPC.save_model")
+    parser.add_argument("--state_size", type=int, default=29)
+    parser.add_argument("--action_size", type=int, default=8)
+    parser.add_argument("--num_rollouts", type=int, default=14000)
+    parser.add_argument("--num_steps", type=int, default=7)
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--num_threads", type=int, default=0, help="torch intra-op threads (0 keeps the default)")
+    parser.add_argument("--modes", nargs="+", default=["eager", "folded", "torchscript"],
+                        choices=["eager", "folded", "torchscript", "compile", "bfloat16", "int8"])
+    parser.add_argument("--num_workers", nargs="*", type=int, default=[],
+                        help="planning thread counts to compare, e.g, 1 2 4 8 16 32")
+    parser.add_argument("--planners", nargs="*", default=[], choices=["random", "cem", "mppi"],
+                        help="planners to compare at their default population sizes")
+    parser.add_argument("--environment", type=str, default="antmaze-umaze-v0", help="reward function for --planners")
+    parser.add_argument("--num_decisions", type=int, default=20, help="(state, goal) pairs to plan for with --planners")
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    run_benchmark(args)
@@ -1,9 +1,14 @@
+from copy import deepcopy
+from contextlib import nullcontext
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class DynamicsModel(nn.Module):
-    def __init__(self, state_size, action_size, device, mean_x=None, mean_y=None, mean_z=None, std_x=None, std_y=None, std_z=None):
+    def __init__(self, state_size, action_size, device, mean_x=None, mean_y=None, mean_z=None, std_x=None, std_y=None, std_z=None,
+                 hidden_size=500):
         super(DynamicsModel, self).__init__()
 
         self.device = device
@@ -12,11 +17,11 @@ class DynamicsModel(nn.Module):
             self.set_standardization_vars(mean_x, mean_y, mean_z, std_x, std_y, std_z)
         
         self.model = nn.Sequential(
-            nn.Linear(state_size + action_size, 500),
+            nn.Linear(state_size + action_size, hidden_size),
             nn.LeakyReLU(),
-            nn.Linear(500, 500),
+            nn.Linear(hidden_size, hidden_size),
             nn.LeakyReLU(),
-            nn.Linear(500, state_size)
+            nn.Linear(hidden_size, state_size)
         )
     
     def forward(self, state, action):
@@ -28,6 +33,9 @@ class DynamicsModel(nn.Module):
     def predict_next_state(self, state, action):
         pred = self.forward(state, action)
         return (pred * self.std_z) + self.mean_z + state
+
+    def loss(self, state, action, norm_state_delta):
+        return F.mse_loss(self.forward(state, action), norm_state_delta)
     
     def set_standardization_vars(self, mean_x, mean_y, mean_z, std_x, std_y, std_z):
         self.mean_x = self._numpy_to_torch(mean_x)
@@ -65,3 +73,211 @@ class DynamicsModel(nn.Module):
         std_y = state_dictionary["std_y"]
         std_z = state_dictionary["std_z"]
         self.set_standardization_vars(mean_x, mean_y, mean_z, std_x, std_y, std_z)
+
+
+class EnsembleLinear(nn.Module):
+    """ `ensemble_size` independent linear layers evaluated as one batched matmul over stacked weights. """
+
+    def __init__(self, ensemble_size, in_features, out_features):
+        super(EnsembleLinear, self).__init__()
+
+        bound = 1. / (in_features ** 0.5)  # same init as nn.Linear
+        self.weight = nn.Parameter(torch.empty((ensemble_size, in_features, out_features)).uniform_(-bound, bound))
+        self.bias = nn.Parameter(torch.empty((ensemble_size, 1, out_features)).uniform_(-bound, bound))
+
+    def forward(self, x):
+        """ x: (ensemble_size, batch_size, in_features) -> (ensemble_size, batch_size, out_features) """
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class EnsembleDynamicsModel(nn.Module):
+    """
+    Probabilistic ensemble of `DynamicsModel`s: every member predicts a gaussian over the
+    standardized state delta, and all members run in a single batched forward pass.
+    During planning, rollout i is always propagated by the same member (TS-inf).
+    """
+    def __init__(self, state_size, action_size, device, ensemble_size=5, sample_next_states=True):
+        super(EnsembleDynamicsModel, self).__init__()
+
+        self.device = device
+        self.state_size = state_size
+        self.ensemble_size = ensemble_size
+        self.sample_next_states = sample_next_states
+
+        self.model = nn.Sequential(
+            EnsembleLinear(ensemble_size, state_size + action_size, 500),
+            nn.LeakyReLU(),
+            EnsembleLinear(ensemble_size, 500, 500),
+            nn.LeakyReLU(),
+            EnsembleLinear(ensemble_size, 500, 2 * state_size)
+        )
+
+        # Soft bounds on the predicted log-variance (Chua et al, 2018)
+        self.max_logvar = nn.Parameter(torch.ones((1, 1, state_size)) / 2.)
+        self.min_logvar = nn.Parameter(-torch.ones((1, 1, state_size)) * 10.)
+
+    def forward(self, state, action):
+        """ Inputs are (ensemble_size, batch_size, dim); returns the mean and log-variance of the standardized delta. """
+        state = (state - self.mean_x) / self.std_x
+        action = (action - self.mean_y) / self.std_y
+        out = self.model(torch.cat([state, action], dim=-1))
+
+        mean, logvar = out[..., :self.state_size], out[..., self.state_size:]
+        logvar = self.max_logvar - F.softplus(self.max_logvar - logvar)
+        logvar = self.min_logvar + F.softplus(logvar - self.min_logvar)
+        return mean, logvar
+
+    def predict_next_state(self, state, action):
+        """ Split the N rollouts into `ensemble_size` contiguous groups, one per member. """
+        num_rollouts = state.shape[0]
+        group_size = -(-num_rollouts // self.ensemble_size)
+        padding = group_size * self.ensemble_size - num_rollouts
+
+        if padding > 0:
+            state = torch.cat([state, state[-1:].expand(padding, -1)], dim=0)
+            action = torch.cat([action, action[-1:].expand(padding, -1)], dim=0)
+
+        grouped_state = state.reshape(self.ensemble_size, group_size, -1)
+        grouped_action = action.reshape(self.ensemble_size, group_size, -1)
+        mean, logvar = self.forward(grouped_state, grouped_action)
+
+        if self.sample_next_states:
+            mean = mean + torch.randn_like(mean) * torch.exp(0.5 * logvar)
+
+        pred = (mean * self.std_z) + self.mean_z + grouped_state
+        return pred.reshape(-1, self.state_size)[:num_rollouts]
+
+    def loss(self, state, action, norm_state_delta):
+        """ Gaussian NLL of all members in one step, each on its own bootstrap resample of the batch. """
+        batch_size = state.shape[0]
+        idx = torch.randint(0, batch_size, (self.ensemble_size, batch_size), device=state.device)
+
+        mean, logvar = self.forward(state[idx], action[idx])
+        inv_var = torch.exp(-logvar)
+        nll = (((mean - norm_state_delta[idx]) ** 2) * inv_var + logvar).mean()
+        return nll + 0.01 * (self.max_logvar.sum() - self.min_logvar.sum())
+
+    def set_standardization_vars(self, mean_x, mean_y, mean_z, std_x, std_y, std_z):
+        self.mean_x = self._numpy_to_torch(mean_x)
+        self.mean_y = self._numpy_to_torch(mean_y)
+        self.mean_z = self._numpy_to_torch(mean_z)
+        self.std_x = self._numpy_to_torch(std_x)
+        self.std_y = self._numpy_to_torch(std_y)
+        self.std_z = self._numpy_to_torch(std_z)
+
+    def _numpy_to_torch(self, arr):
+        return torch.from_numpy(arr).to(self.device).float()
+
+    def __getstate__(self):
+        return {
+            "model": self.model.state_dict(),
+            "max_logvar": self.max_logvar.detach().cpu(),
+            "min_logvar": self.min_logvar.detach().cpu(),
+            "mean_x": self.mean_x.cpu().numpy(),
+            "mean_y": self.mean_y.cpu().numpy(),
+            "mean_z": self.mean_z.cpu().numpy(),
+            "std_x": self.std_x.cpu().numpy(),
+            "std_y": self.std_y.cpu().numpy(),
+            "std_z": self.std_z.cpu().numpy(),
+        }
+
+    def __setstate__(self, state_dictionary):
+        self.model.load_state_dict(state_dictionary["model"])
+        self.model.to(self.device)
+        with torch.no_grad():
+            self.max_logvar.copy_(state_dictionary["max_logvar"])
+            self.min_logvar.copy_(state_dictionary["min_logvar"])
+        mean_x = state_dictionary["mean_x"]
+        mean_y = state_dictionary["mean_y"]
+        mean_z = state_dictionary["mean_z"]
+        std_x = state_dictionary["std_x"]
+        std_y = state_dictionary["std_y"]
+        std_z = state_dictionary["std_z"]
+        self.set_standardization_vars(mean_x, mean_y, mean_z, std_x, std_y, std_z)
+
+
+class FoldedDynamicsModel(nn.Module):
+    """
+    Inference-only copy of a `DynamicsModel` whose input standardization is folded into
+    the first linear layer and whose output de-standardization is folded into the last one,
+    so that a prediction is a single MLP pass plus the residual connection.
+    """
+    def __init__(self, dynamics_model):
+        super(FoldedDynamicsModel, self).__init__()
+
+        self.model = deepcopy(dynamics_model.model)
+        first, last = self.model[0], self.model[-1]
+
+        with torch.no_grad():
+            # W ((x - m) / s) + b = (W / s) x + (b - (W / s) m)
+            in_mean = torch.cat([dynamics_model.mean_x, dynamics_model.mean_y]).to(first.weight.device)
+            in_std = torch.cat([dynamics_model.std_x, dynamics_model.std_y]).to(first.weight.device)
+            first.weight.div_(in_std[None, :])
+            first.bias.sub_(first.weight @ in_mean)
+
+            # (W h + b) * s + m = (s W) h + (s b + m)
+            out_mean = dynamics_model.mean_z.to(last.weight.device)
+            out_std = dynamics_model.std_z.to(last.weight.device)
+            last.weight.mul_(out_std[:, None])
+            last.bias.mul_(out_std).add_(out_mean)
+
+        for param in self.parameters():
+            param.requires_grad_(False)
+
+    def forward(self, state, action):
+        return state + self.model(torch.cat([state, action], dim=1))
+
+
+class CompiledDynamicsModel(object):
+    """
+    Wraps a folded (and optionally TorchScript/torch.compile'd) model behind `predict_next_state`.
+    With `precision` "bfloat16" the MLP runs under bf16 autocast, with "int8" its linear layers are
+    dynamically quantized (CPU only). The residual connection is always added in float32.
+    """
+
+    def __init__(self, dynamics_model, backend="torchscript", precision="float32"):
+        assert backend in ("none", "torchscript", "compile"), backend
+        assert precision in ("float32", "bfloat16", "int8"), precision
+
+        folded = FoldedDynamicsModel(dynamics_model).eval()
+        state_size = dynamics_model.model[-1].out_features
+        action_size = dynamics_model.model[0].in_features - state_size
+        device = dynamics_model.model[0].weight.device
+
+        self.device = device
+        self.precision = precision
+
+        if precision == "bfloat16":
+            assert hasattr(torch, "autocast"), "bfloat16 autocast needs torch>=1.10"
+        elif precision == "int8":
+            assert device.type == "cpu", "Dynamically quantized linear layers only run on the CPU"
+            folded = torch.quantization.quantize_dynamic(folded, {nn.Linear}, dtype=torch.qint8)
+
+        if backend == "torchscript":
+            example_inputs = (torch.zeros((1, state_size), device=device), torch.zeros((1, action_size), device=device))
+            with torch.no_grad(), self._autocast():
+                self.engine = torch.jit.freeze(torch.jit.trace(folded, example_inputs))
+        elif backend == "compile":
+            assert hasattr(torch, "compile"), "torch.compile needs torch>=2.0"
+            self.engine = torch.compile(folded)
+        else:
+            self.engine = folded
+
+        self.backend = backend
+
+    def _autocast(self):
+        if self.precision == "bfloat16":
+            return torch.autocast(self.device.type, dtype=torch.bfloat16)
+        return nullcontext()
+
+    def predict_next_state(self, state, action):
+        with torch.no_grad(), self._autocast():
+            return self.engine(state, action)
+
+
+def max_prediction_error(reference, candidate, states, actions):
+    """ Largest absolute difference between the next-state predictions of two models. """
+    with torch.no_grad():
+        expected = reference.predict_next_state(states, actions)
+        predicted = candidate.predict_next_state(states, actions)
+    return (expected.float() - predicted.float()).abs().max().item()
@@ -1,24 +1,48 @@
 import os
 import pickle
-from copy import deepcopy
+from copy import copy, deepcopy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import numpy as np
-import torch.nn as nn
 from torch.optim import Adam
-from torch.utils.data import Dataset
-from torch.utils.data import DataLoader
+from torch.quasirandom import SobolEngine
 from tqdm import tqdm
 
-from hrl.agent.dynamics.dynamics_model import DynamicsModel
-from hrl.agent.dynamics.dynamics_model import DynamicsModel
+from hrl.agent.dynamics.dynamics_model import DynamicsModel, EnsembleDynamicsModel
+from hrl.agent.dynamics.dynamics_model import CompiledDynamicsModel, max_prediction_error
 from hrl.agent.dynamics.replay_buffer import ReplayBuffer
+from hrl.agent.dynamics.running_stats import RunningMeanStd
+from hrl.agent.dynamics.workspace import MPCWorkspace
+from hrl.agent.dynamics.parallel import ShardedRolloutExecutor
 from hrl.wrappers.gc_mdp_wrapper import GoalConditionedMDPWrapper
 
 
+# Largest one-step deviation (in state units) from the float32 eager model before a planning model is rejected
+PLANNING_TOLERANCES = {"float32": 1e-3, "bfloat16": 5e-2, "int8": 5e-2}
+
+# Sampled action sequences per action for random shooting, per iteration (`planner_iterations`) for CEM/MPPI
+DEFAULT_NUM_ROLLOUTS = {"random": 14000, "cem": 2000, "mppi": 2000}
+
+
 class MPC:
-    def __init__(self, mdp, state_size, action_size, dense_reward, device, multithread=False):
+    def __init__(self, mdp, state_size, action_size, dense_reward, device, multithread=False,
+                 planner="random", num_rollouts=None, planner_iterations=4, elite_fraction=0.1,
+                 cem_alpha=0.1, mppi_temperature=0.5, mppi_noise_std=0.3, fused_costs=True,
+                 warm_start_fraction=0., warm_start_noise_std=0.1,
+                 compiled_inference=False, inference_backend="torchscript", inference_tolerance=None,
+                 inference_precision="float32", ensemble_size=1, drift_eval_every=32, drift_smoothing=0.1,
+                 student_hidden_size=0, student_rescore_top_k=0, planning_workers=0,
+                 adaptive_sampling=False, sample_chunk_size=2048, adaptive_tolerance=1e-3, adaptive_patience=1,
+                 replay_buffer=None):
         assert isinstance(mdp, GoalConditionedMDPWrapper)
+        assert planner in ("random", "cem", "mppi"), planner
+        assert inference_precision != "int8" or torch.device(device).type == "cpu", \
+            f"int8 planning models (dynamically quantized) only run on the CPU, not on {device}"
+        assert ensemble_size == 1 or not (compiled_inference or inference_precision != "float32"), \
+            f"Ensemble planning only runs the eager float32 model, got compiled_inference={compiled_inference}, " \
+            f"inference_precision={inference_precision}"
 
         self.mdp = mdp
         self.device = device
@@ -30,38 +54,349 @@ class MPC:
         self.trained_options = []
         self.gamma = 0.95
 
-        self.model = DynamicsModel(self.state_size, self.action_size, self.device)
+        # Action selection: one-shot random shooting, or iterative refinement
+        # of a sampling distribution with CEM/MPPI (`num_rollouts` per iteration)
+        self.planner = planner
+        self.num_rollouts = num_rollouts if num_rollouts is not None else DEFAULT_NUM_ROLLOUTS[planner]
+        self.planner_iterations = planner_iterations
+        self.elite_fraction = elite_fraction
+        self.cem_alpha = cem_alpha
+        self.mppi_temperature = mppi_temperature
+        self.mppi_noise_std = mppi_noise_std
+        # Accumulate rollout costs on-device inside the prediction loop (see `simulate_fused`)
+        self.fused_costs = fused_costs
+
+        # Receding-horizon warm start: the previous step's best action sequence, shifted by
+        # one step, seeds `warm_start_fraction` of the next population (0 disables it)
+        self.warm_start_fraction = warm_start_fraction
+        self.warm_start_noise_std = warm_start_noise_std
+        # `act_sequence` needs the best sequence even without warm starting
+        self.keep_best_sequence = False
+        self.reset_plan()
+
+        # Adaptive sample budget for random shooting: evaluate scrambled Sobol action sequences
+        # `sample_chunk_size` at a time, and stop once the best cost has improved by at most
+        # `adaptive_tolerance` for `adaptive_patience` chunks in a row (or after `num_rollouts`)
+        self.adaptive_sampling = adaptive_sampling
+        self.sample_chunk_size = sample_chunk_size
+        self.adaptive_tolerance = adaptive_tolerance
+        self.adaptive_patience = adaptive_patience
+        self.sobol_engines = {}
+        self.samples_per_decision = deque(maxlen=1000)  # of the most recent decisions
+
+        # Preallocated planner buffers, one per (num_rollouts, num_steps) configuration
+        self.workspaces = {}
+
+        self.planners = {
+            "random": self._random_shooting,
+            "cem": self._cross_entropy_method,
+            "mppi": self._mppi,
+        }
+
+        # A single deterministic model, or a probabilistic ensemble when `ensemble_size` > 1
+        self.ensemble_size = ensemble_size
+        self.model = self._make_model()
         self.model.to(self.device)
-        
-        self.replay_buffer = ReplayBuffer(obs_dim=state_size, act_dim=action_size, size=int(3e5))
-
-        if multithread:
-            self.workers = os.cpu_count() - 2
-        else:
-            self.workers = 0
 
-    def load_data(self):
-        self.dataset = self._preprocess_data()
+        # Optionally plan with a compiled copy of `model` that has the standardization folded in.
+        # It is rebuilt (and checked against the eager model) whenever the model changes.
+        self.compiled_inference = compiled_inference
+        self.inference_backend = inference_backend
+        # Planning-only reduced precision ("bfloat16" autocast or "int8" dynamic quantization);
+        # training always uses the float32 `model`. Reduced precision tolerates a larger deviation.
+        assert inference_precision in PLANNING_TOLERANCES, inference_precision
+        self.inference_precision = inference_precision
+        self.inference_tolerance = inference_tolerance if inference_tolerance is not None \
+                                    else PLANNING_TOLERANCES[inference_precision]
+        self.planning_model = None
+        self.planning_model_error = None
+
+        # Optionally plan with a small student network distilled from `model` (see `distill`), and
+        # let the teacher re-score the `student_rescore_top_k` best random shooting candidates
+        self.student_hidden_size = student_hidden_size
+        self.student_rescore_top_k = student_rescore_top_k
+        self.student = None
+        self.student_ready = False
+        self.planning_model_source = None
+        
+        # Possibly a transition store shared with the TD3 learners, which must only be written through `step`
+        self.replay_buffer = replay_buffer if replay_buffer is not None \
+                                else ReplayBuffer(obs_dim=state_size, act_dim=action_size, size=int(3e5))
+
+        # Standardization statistics of the buffer contents, maintained incrementally in `step`
+        self.state_stats = RunningMeanStd(state_size)
+        self.action_stats = RunningMeanStd(action_size)
+        self.delta_stats = RunningMeanStd(state_size)
+
+        # Streaming one-step prediction error of the trained model on newly stored transitions,
+        # evaluated in `step` every `drift_eval_every` transitions (see `needs_retraining`)
+        self.drift_eval_every = drift_eval_every
+        self.drift_smoothing = drift_smoothing
+        self.reference_error = None
+        self._reset_drift_statistics()
+
+        # Sharded planning: split every rollout population across `planning_workers` threads
+        assert not multithread or planning_workers > 1, f"Sharded planning needs planning_workers > 1, got {planning_workers}"
+        self.workers = planning_workers if multithread else 0
+        self.rollout_executor = ShardedRolloutExecutor(self.workers) if multithread else None
+
+        # Single background thread for speculative planning (see `act_async`), created on first use
+        self.background_planner = None
+
+        # Single background thread that trains copies of the models (see `start_background_training`)
+        self.background_trainer = None
+        self.background_training = None
+
+    def load_data(self, snapshot=False):
+        """ If `snapshot`, the dataset is a copy of the replay buffer instead of a view that `step` keeps overwriting. """
+        self.dataset = self._preprocess_data(snapshot)
         self.model.set_standardization_vars(*self._get_standardization_vars())
+        self.planning_model = None
+        self.student_ready = False
 
     def train(self, epochs=100, batch_size=512):
         self.is_trained = True
 
-        training_gen = DataLoader(self.dataset, batch_size=batch_size, num_workers=self.workers, shuffle=True,  pin_memory=True)
-        loss_function = nn.MSELoss().to(self.device)
         optimizer = Adam(self.model.parameters(), lr=1e-3)
         
-        for epoch in tqdm(range(epochs), desc=f'Training MPC model on {self.replay_buffer.size} points'):
-            for states, actions, states_p in training_gen:
-                states = states.to(self.device).float()
-                actions = actions.to(self.device).float()
-                states_p = states_p.to(self.device).float()
-            
-                optimizer.zero_grad()
-                p = self.model.forward(states, actions)
-                loss = loss_function(p, states_p)
-                loss.backward()
-                optimizer.step()
+        for epoch in tqdm(range(epochs), desc=f'Training MPC model on {len(self.dataset)} points'):
+            for states, actions, states_p in self.dataset.iterate_minibatches(batch_size):
+                self._gradient_step(optimizer, states, actions, states_p)
+
+        self.planning_model = None
+        self._set_drift_reference()
+
+    def train_steps(self, num_gradient_steps, batch_size=512, recent_fraction=0.5, recent_window=int(2e4)):
+        """ Fixed compute budget: `num_gradient_steps` updates regardless of the buffer size, with
+        `recent_fraction` of every minibatch drawn from the newest `recent_window` transitions. """
+        self.is_trained = True
+
+        optimizer = Adam(self.model.parameters(), lr=1e-3)
+
+        num_samples = len(self.dataset)
+        window = min(recent_window, num_samples)
+        num_recent = int(recent_fraction * batch_size)
+
+        for _ in tqdm(range(num_gradient_steps), desc=f'Training MPC model for {num_gradient_steps} steps'):
+            # The buffer is a ring, so the newest transition of the dataset sits just before its `ptr`
+            ages = torch.randint(0, window, (num_recent,))
+            recent_idx = (self.dataset.ptr - 1 - ages) % num_samples
+            uniform_idx = torch.randint(0, num_samples, (batch_size - num_recent,))
+            idx = torch.cat((recent_idx, uniform_idx)).to(self.device)
+
+            states, actions, states_p = self.dataset.get_minibatch(idx)
+            self._gradient_step(optimizer, states, actions, states_p)
+
+        self.planning_model = None
+        self._set_drift_reference()
+
+    def start_background_training(self, epochs=5, num_gradient_steps=None, batch_size=512, recent_fraction=0.5,
+                                  distill_steps=0):
+        """ `load_data` and `train` (or `train_steps` if `num_gradient_steps` is set, and then `distill` if
+        `distill_steps` > 0) on copies of the models on a background thread, while this MPC keeps planning
+        with (and storing transitions for) the current ones. `finish_background_training` swaps them in. """
+        assert self.background_training is None, "The previous background training was not finished"
+
+        trainer = copy(self)
+        trainer.model = self._copy_model(self.model, self._make_model())
+        if self.student is not None:
+            trainer.student = self._copy_model(self.student, DynamicsModel(self.state_size, self.action_size, self.device,
+                                                                           hidden_size=self.student_hidden_size))
+
+        # On this thread, while the buffer and its running statistics are consistent; the dataset and
+        # statistics are snapshots since this MPC keeps overwriting the oldest transitions meanwhile
+        trainer.state_stats, trainer.action_stats, trainer.delta_stats = \
+            deepcopy((self.state_stats, self.action_stats, self.delta_stats))
+        trainer.load_data(snapshot=True)
+
+        # Nothing the trainer touches is shared with this MPC's planning: no buffer, workspaces or threads
+        trainer.replay_buffer = None
+        trainer.workspaces, trainer.sobol_engines = {}, {}
+        trainer.rollout_executor, trainer.background_planner, trainer.background_trainer = None, None, None
+
+        if self.background_trainer is None:
+            self.background_trainer = ThreadPoolExecutor(max_workers=1)
+        self.background_training = self.background_trainer.submit(self._train_copy, trainer, epochs, num_gradient_steps,
+                                                                  batch_size, recent_fraction, distill_steps)
+
+    @staticmethod
+    def _train_copy(trainer, epochs, num_gradient_steps, batch_size, recent_fraction, distill_steps):
+        if num_gradient_steps is None:
+            trainer.train(epochs=epochs, batch_size=batch_size)
+        else:
+            trainer.train_steps(num_gradient_steps, batch_size=batch_size, recent_fraction=recent_fraction)
+        if distill_steps > 0:
+            trainer.distill(num_gradient_steps=distill_steps)
+        return trainer
+
+    @staticmethod
+    def _copy_model(model, new_model):
+        """ Load the weights and standardization statistics of `model` into `new_model` (see `save_model`). """
+        new_model.__setstate__(model.__getstate__())
+        return new_model.to(model.device)
+
+    def finish_background_training(self, wait=False):
+        """ Swap in the models trained by `start_background_training` if it is done (or `wait` for it); returns whether it did. """
+        if self.background_training is None or not (wait or self.background_training.done()):
+            return False
+
+        trainer = self.background_training.result()
+        self.background_training = None
+
+        self.model = trainer.model
+        self.student = trainer.student
+        self.student_ready = trainer.student_ready
+        self.dataset = trainer.dataset
+        self.mean_x, self.mean_y, self.mean_z, self.std_x, self.std_y, self.std_z = trainer._get_standardization_vars()
+        self.is_trained = True
+        self.planning_model = None
+        self._set_drift_reference()
+        return True
+
+    def distill(self, num_gradient_steps=1000, batch_size=1024, random_action_fraction=0.5):
+        """ Fit the small `student` to the teacher's next-state predictions on buffer states, paired with buffer
+        actions and, for `random_action_fraction` of every minibatch, uniformly random ones like the planner's. """
+        assert self.student_hidden_size > 0, "MPC was created without a student model"
+
+        if self.student is None:
+            self.student = DynamicsModel(self.state_size, self.action_size, self.device, hidden_size=self.student_hidden_size)
+            self.student.to(self.device)
+        self.student.set_standardization_vars(*self._get_standardization_vars())
+
+        optimizer = Adam(self.student.parameters(), lr=1e-3)
+
+        num_samples = len(self.dataset)
+        num_random = int(random_action_fraction * batch_size)
+
+        for _ in tqdm(range(num_gradient_steps), desc=f'Distilling MPC model into {self.student_hidden_size} unit student'):
+            idx = torch.randint(0, num_samples, (batch_size,), device=self.device)
+            states, actions, _ = self.dataset.get_minibatch(idx)
+            actions[:num_random].uniform_(-1., 1.)
+
+            with torch.no_grad():
+                states_p = self.model.predict_next_state(states, actions)
+
+            self._gradient_step(optimizer, states, actions, states_p, model=self.student)
+
+        self.student_ready = True
+        self.planning_model = None
+
+    def _gradient_step(self, optimizer, states, actions, states_p, model=None):
+        model = self.model if model is None else model
+        norm_states_delta = (states_p - states - model.mean_z) / model.std_z
+
+        optimizer.zero_grad()
+        loss = model.loss(states, actions, norm_states_delta)
+        loss.backward()
+        optimizer.step()
+
+    def needs_retraining(self, error_ratio=2., state_shift=1.):
+        """ Whether the model has gone stale since it was last trained: its streaming one-step error
+        exceeds `error_ratio` times the error on its training data, or the mean of the recently visited
+        states moved by more than `state_shift` standard deviations (in any dimension) from the training mean. """
+
+        if not self.is_trained:
+            return True
+
+        if self.prediction_error is None:
+            return False
+
+        if self.prediction_error > error_ratio * self.reference_error:
+            return True
+
+        shift = np.abs(self.recent_state_mean - self.mean_x) / self.std_x
+        return shift.max() > state_shift
+
+    def _one_step_error(self, idx):
+        """ Mean squared error of the predicted state deltas (in units of the delta std) of the transitions at `idx`. """
+        states = torch.as_tensor(self.replay_buffer.obs_buf[idx], device=self.device)
+        actions = torch.as_tensor(self.replay_buffer.act_buf[idx], device=self.device)
+        states_p = torch.as_tensor(self.replay_buffer.obs2_buf[idx], device=self.device)
+
+        with torch.no_grad():
+            predictions = self.model.predict_next_state(states, actions)
+            error = ((predictions - states_p) / self.model.std_z).pow(2).mean()
+
+        return error.item()
+
+    def _get_recent_indices(self, num_transitions):
+        """ Buffer indices of the newest `num_transitions` transitions, newest first. """
+        num_transitions = min(num_transitions, self.replay_buffer.size)
+        return (self.replay_buffer.ptr - 1 - np.arange(num_transitions)) % self.replay_buffer.size
+
+    def _set_drift_reference(self, num_transitions=4096):
+        # A background trainer has no buffer; `finish_background_training` sets the reference of its model
+        if self.replay_buffer is None:
+            return
+        self.reference_error = self._one_step_error(self._get_recent_indices(num_transitions))
+        self._reset_drift_statistics()
+
+    def _reset_drift_statistics(self):
+        self.prediction_error = None
+        self.recent_state_mean = None
+        self.num_unevaluated_transitions = 0
+
+    def _update_drift_statistics(self):
+        idx = self._get_recent_indices(self.num_unevaluated_transitions)
+        self.num_unevaluated_transitions = 0
+
+        error = self._one_step_error(idx)
+        state_mean = self.replay_buffer.obs_buf[idx].mean(axis=0)
+
+        if self.prediction_error is None:
+            self.prediction_error, self.recent_state_mean = error, state_mean
+        else:
+            alpha = self.drift_smoothing
+            self.prediction_error = (1 - alpha) * self.prediction_error + alpha * error
+            self.recent_state_mean = (1 - alpha) * self.recent_state_mean + alpha * state_mean
+
+    def get_planning_model(self):
+        """ Model used for the forward passes in `simulate`: the eager model (or the distilled student) or its compiled copy. """
+
+        source = self.student if self.student_ready else self.model
+
+        reduced_precision = self.inference_precision != "float32"
+        if not (self.compiled_inference or reduced_precision) or not hasattr(source, "mean_x"):
+            return source
+
+        # Folding/compilation is only implemented for the single deterministic model
+        if not isinstance(source, DynamicsModel):
+            return source
+
+        if self.planning_model is None or self.planning_model_source is not source:
+            self.planning_model = self._compile_model(source)
+            self.planning_model_source = source
+
+        return self.planning_model
+
+    def _compile_model(self, model):
+        backend = self.inference_backend if self.compiled_inference else "none"
+        compiled_model = CompiledDynamicsModel(model, backend=backend, precision=self.inference_precision)
+        states, actions = self._sample_validation_inputs(model)
+        error = max_prediction_error(model, compiled_model, states, actions)
+        self.planning_model_error = error
+
+        if error > self.inference_tolerance:
+            print(f"[MPC] {backend}/{self.inference_precision} dynamics model deviates from eager by {error}, using eager model")
+            return model
+
+        if self.inference_precision != "float32":
+            print(f"[MPC] Planning with {self.inference_precision} dynamics model, max one-step deviation from float32: {error}")
+
+        return compiled_model
+
+    def _sample_validation_inputs(self, model, num_samples=1024):
+        """ Held-in (state, action) pairs to compare planning models against the eager model. """
+
+        if self.replay_buffer.size > 0:
+            idx = np.random.randint(0, self.replay_buffer.size, size=num_samples)
+            states = torch.as_tensor(self.replay_buffer.obs_buf[idx], device=self.device)
+            actions = torch.as_tensor(self.replay_buffer.act_buf[idx], device=self.device)
+        else:
+            states = model.mean_x + model.std_x * torch.randn((num_samples, self.state_size), device=self.device)
+            actions = 2 * torch.rand((num_samples, self.action_size), device=self.device) - 1
+
+        return states, actions
 
     def rollout(self, mdp, num_rollouts, num_steps, goal, max_steps):
         steps_taken = 0
@@ -146,22 +481,35 @@ class MPC:
         costs = -1. * rewards
         return costs
 
-    def simulate(self, s, goal, num_rollouts=14000, num_steps=7):
-        """ Perform N simulations of length H. """
+    def get_workspace(self, num_rollouts, num_steps):
+        key = (num_rollouts, num_steps)
+        if key not in self.workspaces:
+            self.workspaces[key] = MPCWorkspace(num_rollouts, num_steps, self.state_size,
+                                                self.action_size, self.gamma, self.device)
+        return self.workspaces[key]
 
-        torch_actions = 2 * torch.rand((num_rollouts, num_steps, self.action_size), device=self.device) - 1
-        torch_states = torch.tensor(s, device=self.device).repeat(num_rollouts, 1)
-        pred = torch.zeros((num_rollouts, self.state_size, num_steps), device=self.device)
-        
-        goals = np.repeat([goal], num_rollouts, axis=0)
-        costs = np.zeros((num_rollouts, num_steps))
+    def simulate(self, s, goal, num_rollouts=14000, num_steps=7, actions=None):
+        """ Perform N simulations of length H. If `actions` is None, sample them uniformly.
+        The outputs live in the planner workspace and are overwritten by the next call. """
+
+        workspace = self.get_workspace(num_rollouts, num_steps)
+
+        if actions is None:
+            torch_actions = workspace.sample_uniform_actions()
+        else:
+            assert actions.shape == (num_rollouts, num_steps, self.action_size), f"{actions.shape}"
+            torch_actions = actions
+        torch_states = workspace.fill_states(s)
+        pred, goals, costs = workspace.get_simulation_buffers(goal)
+
+        model = self.get_planning_model()
 
         with torch.no_grad():
             # compute next states for each step
             for j in range(num_steps):
                 actions = torch_actions[:, j, :]
 
-                prediction = self.model.predict_next_state(torch_states.float(), actions.float())
+                prediction = model.predict_next_state(torch_states, actions.float())
                 torch_states = prediction
                 pred[:,:,j] = prediction
 
@@ -173,21 +521,372 @@ class MPC:
 
         return np_pred[:, :, num_steps - 1], np_actions, costs
 
-    def act(self, s, goal, vf=None, num_rollouts=14000, num_steps=7):
-        # sample actions for all steps
-        final_states, actions, costs = self.simulate(s, goal, num_rollouts, num_steps)
+    def simulate_fused(self, s, goal, num_rollouts=14000, num_steps=7, actions=None):
+        """ Like `simulate`, but only keep the running discounted cost, the first action and the final state. """
 
-        # choose next action to execute
-        gammas = np.power(self.gamma * np.ones(num_steps), np.arange(0, num_steps))
-        cumulative_costs = np.sum(costs * gammas, axis=1)
+        workspace = self.get_workspace(num_rollouts, num_steps)
+        torch_states = workspace.fill_states(s)
+        torch_goals = torch.as_tensor(goal[:2], device=self.device).float().expand(num_rollouts, 2)
+
+        return self._fused_rollout(torch_states, torch_goals, num_steps, actions, workspace)
+
+    def simulate_many(self, states, goals, num_rollouts=14000, num_steps=7, max_batch_size=int(2e5)):
+        """ Perform N simulations of length H from each of K (state, goal) pairs in batched forward passes.
+
+        Rollouts of all pairs are flattened into one batch, which is processed in chunks of at
+        most `max_batch_size` rows and reduced per pair on-device as it goes, so memory does not
+        grow with N. Returns, per pair, the elementwise max over rollouts of the final (x, y)
+        position (K x 2), and the first action (K x A) and discounted cost (K) of the cheapest rollout.
+        """
+        states = np.asarray(states)
+        goals = np.asarray(goals)[:, :2]
+        num_pairs = states.shape[0]
+
+        assert states.shape == (num_pairs, self.state_size), f"{states.shape}"
+        assert goals.shape == (num_pairs, 2), f"{goals.shape}"
+
+        torch_states = torch.as_tensor(states, device=self.device).float()
+        torch_goals = torch.as_tensor(goals, device=self.device).float()
+
+        farthest_positions = torch.full((num_pairs, 2), -np.inf, device=self.device)
+        best_actions = torch.zeros((num_pairs, self.action_size), device=self.device)
+        best_costs = torch.full((num_pairs,), np.inf, device=self.device)
+
+        total_rollouts = num_pairs * num_rollouts
+        for start in range(0, total_rollouts, max_batch_size):
+            end = min(start + max_batch_size, total_rollouts)
+            pair_idx = torch.arange(start, end, device=self.device) // num_rollouts
+
+            final_states, first_actions, costs = self._fused_rollout(torch_states[pair_idx], torch_goals[pair_idx], num_steps)
+
+            # A chunk can start and end in the middle of a pair; split it at the pair boundaries
+            first_pair = start // num_rollouts
+            boundaries = [start] + list(range((first_pair + 1) * num_rollouts, end, num_rollouts)) + [end]
+            segments = [b - a for a, b in zip(boundaries[:-1], boundaries[1:])]
+
+            for pair, (positions, actions, pair_costs) in enumerate(zip(torch.split(final_states[:, :2], segments),
+                                                                        torch.split(first_actions, segments),
+                                                                        torch.split(costs, segments)), first_pair):
+                farthest_positions[pair] = torch.max(farthest_positions[pair], positions.max(dim=0)[0])
+                best = torch.argmin(pair_costs)
+                improved = pair_costs[best] < best_costs[pair]
+                best_actions[pair] = torch.where(improved, actions[best].float(), best_actions[pair])
+                best_costs[pair] = torch.min(best_costs[pair], pair_costs[best])
+
+        return farthest_positions.cpu().numpy(), best_actions.cpu().numpy(), best_costs.cpu().numpy()
+
+    def _fused_rollout(self, torch_states, torch_goals, num_steps, actions=None, workspace=None, model=None):
+        """ Roll the (planning) model forward from a batch of states, accumulating discounted costs on-device. """
+
+        # Resolve (and possibly compile) the planning model once, before any worker thread uses it
+        model = self.get_planning_model() if model is None else model
+
+        if self.rollout_executor is None or torch_states.shape[0] < self.workers:
+            return self._rollout_shard(torch_states, torch_goals, num_steps, actions, workspace, model)
+
+        return self.rollout_executor.run(self._rollout_shard, torch_states, torch_goals, num_steps, actions, workspace, model)
+
+    def _rollout_shard(self, torch_states, torch_goals, num_steps, actions, workspace, model):
+        reward_function = self.mdp.dense_gc_reward_func_torch if self.dense_reward \
+                            else self.mdp.sparse_gc_reward_func_torch
+
+        num_rollouts = torch_states.shape[0]
+
+        if workspace is None:
+            cumulative_costs = torch.zeros((num_rollouts,), device=self.device)
+        else:
+            cumulative_costs = workspace.cumulative_costs.zero_()
+
+        with torch.no_grad():
+            for j in range(num_steps):
+                if actions is not None:
+                    step_actions = actions[:, j, :]
+                elif workspace is not None:
+                    step_actions = workspace.step_actions.uniform_(-1., 1.)
+                else:
+                    step_actions = 2 * torch.rand((num_rollouts, self.action_size), device=self.device) - 1
+
+                if j == 0:
+                    # The per-step workspace buffer is refilled, so keep a copy of the first actions
+                    first_actions = step_actions if workspace is None or actions is not None \
+                                    else workspace.first_actions.copy_(step_actions)
+
+                torch_states = model.predict_next_state(torch_states, step_actions.float())
+                rewards, _ = reward_function(torch_states, torch_goals)
+                cumulative_costs.sub_(rewards, alpha=self.gamma ** j)
+
+        return torch_states, first_actions, cumulative_costs
+
+    def act(self, s, goal, vf=None, num_rollouts=None, num_steps=7):
+        num_rollouts = self.num_rollouts if num_rollouts is None else num_rollouts
+
+        if self.plan is not None and not self._is_plan_valid(goal, num_steps):
+            self.reset_plan()
+
+        return self.planners[self.planner](s, goal, vf, num_rollouts, num_steps)
+
+    def act_async(self, s, goal, vf=None, num_rollouts=None, num_steps=7):
+        """ Run `act` in the background planning thread and return its future. The planner buffers
+        are shared, so wait for the result before planning again from any other thread. """
+        if self.background_planner is None:
+            self.background_planner = ThreadPoolExecutor(max_workers=1)
+        return self.background_planner.submit(self.act, s, goal, vf, num_rollouts, num_steps)
+
+    def predict_next_state(self, s, action):
+        """ The model's prediction of the state after executing `action` in `s`. """
+        torch_state = torch.as_tensor(s, device=self.device).float()[None, :]
+        torch_action = torch.as_tensor(action, device=self.device).float()[None, :]
+
+        with torch.no_grad():
+            return self.model.predict_next_state(torch_state, torch_action)[0].cpu().numpy()
+
+    def act_sequence(self, s, goal, vf=None, num_rollouts=None, num_steps=7):
+        """ Plan like `act`, but return the whole best action sequence (H x A) and the
+        states (H x S) the model predicts along it, e.g, to execute several actions open loop. """
+
+        self.keep_best_sequence = True
+        try:
+            self.act(s, goal, vf=vf, num_rollouts=num_rollouts, num_steps=num_steps)
+        finally:
+            self.keep_best_sequence = False
+
+        predicted_states = torch.empty((num_steps, self.state_size), device=self.device)
+        torch_state = torch.as_tensor(s, device=self.device).float()[None, :]
+
+        with torch.no_grad():
+            for j in range(num_steps):
+                torch_state = self.model.predict_next_state(torch_state, self.plan[j:j+1])
+                predicted_states[j] = torch_state[0]
+
+        return self.plan.cpu().numpy(), predicted_states.cpu().numpy()
+
+    def advance_plan(self, num_actions):
+        """ Drop the first `num_actions` of the saved plan after they were executed (beyond the single
+        step that `_get_warm_start` already shifts by), padding the end with uniform actions. """
+        if self.plan is None or num_actions <= 0:
+            return
+
+        num_actions = min(num_actions, self.plan.shape[0])
+        padding = 2 * torch.rand((num_actions, self.action_size), device=self.device) - 1
+        self.plan = torch.cat((self.plan[num_actions:], padding), dim=0)
+
+    def reset_plan(self):
+        """ Forget the warm-start action sequence, e.g, when the goal or the executing option changes. """
+        self.plan = None
+        self.plan_goal = None
+
+    def get_plan_state(self):
+        """ The warm-start action sequence and its goal, e.g, to `set_plan_state` back after a discarded plan. """
+        return self.plan, self.plan_goal
+
+    def set_plan_state(self, plan_state):
+        self.plan, self.plan_goal = plan_state
+
+    def _is_plan_valid(self, goal, num_steps):
+        return self.plan.shape[0] == num_steps and np.allclose(self.plan_goal, goal[:2])
+
+    def _save_plan(self, goal, action_sequence):
+        if self.warm_start_fraction > 0 or self.keep_best_sequence:
+            self.plan = action_sequence.clone()
+            self.plan_goal = np.array(goal[:2])
+
+    def _get_warm_start(self):
+        """ Previous best action sequence shifted forward by one step, padded with a uniform action. """
+        if self.warm_start_fraction <= 0 or self.plan is None:
+            return None
+        last_action = 2 * torch.rand((1, self.action_size), device=self.device) - 1
+        return torch.cat((self.plan[1:], last_action), dim=0)
+
+    def _sample_action_sequences(self, num_rollouts, num_steps):
+        workspace = self.get_workspace(num_rollouts, num_steps)
+        actions = workspace.sample_uniform_actions()
+        return self._add_warm_start(actions, workspace, self._get_warm_start())
+
+    def _add_warm_start(self, actions, workspace, warm_start):
+        """ Replace the first `warm_start_fraction` of the sequences by perturbations of the warm start. """
+        if warm_start is not None:
+            num_warm = max(1, int(self.warm_start_fraction * workspace.num_rollouts))
+            noise = workspace.noise[:num_warm].normal_()
+            torch.add(warm_start, noise, alpha=self.warm_start_noise_std, out=actions[:num_warm])
+            actions[:num_warm].clamp_(-1., 1.)
+            actions[0] = warm_start
+
+        return actions
+
+    def _sample_sobol_actions(self, workspace):
+        """ Fill the workspace with the next points of a scrambled Sobol sequence over whole action sequences. """
+        dimension = workspace.num_steps * self.action_size
+        if dimension not in self.sobol_engines:
+            self.sobol_engines[dimension] = SobolEngine(dimension, scramble=True)
+
+        samples = self.sobol_engines[dimension].draw(workspace.num_rollouts)
+        return workspace.actions.copy_(samples.view_as(workspace.actions)).mul_(2.).sub_(1.)
+
+    def _evaluate(self, s, goal, vf, num_rollouts, num_steps, actions=None):
+        """ Cumulative (discounted + terminal) cost and first action of each rollout, as numpy arrays.
+        These may share memory with the planner workspace, so copy anything that must outlive the call. """
+
+        if self.fused_costs:
+            final_states, first_actions, cumulative_costs = self.simulate_fused(s, goal, num_rollouts, num_steps, actions)
+            final_states = final_states.cpu().numpy()
+            first_actions = first_actions.cpu().numpy()
+            cumulative_costs = cumulative_costs.cpu().numpy()
+        else:
+            final_states, all_actions, costs = self.simulate(s, goal, num_rollouts, num_steps, actions)
+            gammas = self.get_workspace(num_rollouts, num_steps).gammas
+            cumulative_costs = np.dot(costs, gammas)
+            first_actions = all_actions[:, 0, :]
 
         if vf is not None:
             cumulative_costs = self._add_terminal_costs(cumulative_costs, final_states, goal, num_steps, vf)
 
-        index = np.argmin(cumulative_costs) # retrieve action with least trajectory distance to goal
-        action = actions[index, 0, :] # grab action corresponding to least distance
+        return cumulative_costs, first_actions
+
+    def _random_shooting(self, s, goal, vf, num_rollouts, num_steps):
+        if self.adaptive_sampling:
+            return self._adaptive_random_shooting(s, goal, vf, num_rollouts, num_steps)
+
+        # sample actions for all steps; we only need the whole sequences to warm start the next call
+        # or to re-simulate the best candidates with the teacher model
+        rescore = self.student_ready and self.student_rescore_top_k > 0
+        keep_sequences = self.warm_start_fraction > 0 or self.keep_best_sequence or rescore
+        torch_actions = self._sample_action_sequences(num_rollouts, num_steps) if keep_sequences else None
+        cumulative_costs, first_actions = self._evaluate(s, goal, vf, num_rollouts, num_steps, torch_actions)
+
+        # choose next action to execute
+        if rescore:
+            index = self._rescore_with_teacher(s, goal, vf, num_steps, cumulative_costs, torch_actions)
+        else:
+            index = np.argmin(cumulative_costs) # retrieve action with least trajectory distance to goal
+        action = first_actions[index].copy() # grab action corresponding to least distance
+
+        if torch_actions is not None:
+            self._save_plan(goal, torch_actions[index])
+
         return action
 
+    def _adaptive_random_shooting(self, s, goal, vf, num_rollouts, num_steps):
+        """ Random shooting with at most `num_rollouts` low-discrepancy samples, stopping early once the best cost plateaus. """
+
+        warm_start = self._get_warm_start()
+
+        best_cost, best_action, best_sequence = np.inf, None, None
+        num_samples, stalled_chunks = 0, 0
+
+        # The `student_rescore_top_k` cheapest sequences under the student, carried across chunks for the teacher
+        rescore = self.student_ready and self.student_rescore_top_k > 0
+        candidate_costs = np.zeros((0,), dtype=np.float32)
+        candidate_sequences = torch.zeros((0, num_steps, self.action_size), device=self.device)
+
+        while num_samples < num_rollouts and stalled_chunks < self.adaptive_patience:
+            # The last chunk only takes the samples left in the `num_rollouts` budget
+            chunk_size = min(self.sample_chunk_size, num_rollouts - num_samples)
+            workspace = self.get_workspace(chunk_size, num_steps)
+
+            torch_actions = self._sample_sobol_actions(workspace)
+            if num_samples == 0:
+                torch_actions = self._add_warm_start(torch_actions, workspace, warm_start)
+
+            cumulative_costs, first_actions = self._evaluate(s, goal, vf, chunk_size, num_steps, torch_actions)
+            num_samples += chunk_size
+
+            index = np.argmin(cumulative_costs)
+            improvement = best_cost - cumulative_costs[index]
+            stalled_chunks = stalled_chunks + 1 if improvement <= self.adaptive_tolerance else 0
+
+            if improvement > 0:
+                best_cost = cumulative_costs[index]
+                best_action = first_actions[index].copy()
+                best_sequence = torch_actions[index].clone()
+
+            if rescore:
+                candidate_costs = np.concatenate((candidate_costs, cumulative_costs))
+                candidate_sequences = torch.cat((candidate_sequences, torch_actions.float()))
+                keep = np.argpartition(candidate_costs, min(self.student_rescore_top_k, len(candidate_costs)) - 1)
+                keep = keep[:self.student_rescore_top_k]
+                candidate_costs = candidate_costs[keep]
+                candidate_sequences = candidate_sequences[torch.as_tensor(keep, device=self.device)]
+
+        if rescore:
+            index = self._rescore_with_teacher(s, goal, vf, num_steps, candidate_costs, candidate_sequences)
+            best_sequence = candidate_sequences[index]
+            best_action = best_sequence[0].cpu().numpy()
+
+        self.samples_per_decision.append(num_samples)
+        self._save_plan(goal, best_sequence)
+
+        return best_action
+
+    def _rescore_with_teacher(self, s, goal, vf, num_steps, cumulative_costs, torch_actions):
+        """ Index of the best of the `student_rescore_top_k` cheapest (under the student) sequences according to the teacher. """
+        k = min(self.student_rescore_top_k, len(cumulative_costs))
+        top_idx = np.argpartition(cumulative_costs, k - 1)[:k]
+
+        torch_states = torch.as_tensor(s, device=self.device).float().expand(k, self.state_size)
+        torch_goals = torch.as_tensor(goal[:2], device=self.device).float().expand(k, 2)
+        sequences = torch_actions[torch.as_tensor(top_idx, device=self.device)]
+
+        final_states, _, costs = self._fused_rollout(torch_states, torch_goals, num_steps, sequences, model=self.model)
+        costs = costs.cpu().numpy()
+
+        if vf is not None:
+            costs = self._add_terminal_costs(costs, final_states.cpu().numpy(), goal, num_steps, vf)
+
+        return top_idx[np.argmin(costs)]
+
+    def _cross_entropy_method(self, s, goal, vf, num_rollouts, num_steps):
+        """ Refit a diagonal gaussian to the lowest cost action sequences for a few iterations. """
+
+        num_elites = max(2, int(self.elite_fraction * num_rollouts))
+        warm_start = self._get_warm_start()
+        mean = torch.zeros((num_steps, self.action_size), device=self.device) if warm_start is None else warm_start
+        std = torch.ones((num_steps, self.action_size), device=self.device) / np.sqrt(3.)  # std of U(-1, 1)
+
+        best_cost, best_action, best_sequence = np.inf, None, None
+        workspace = self.get_workspace(num_rollouts, num_steps)
+
+        for _ in range(self.planner_iterations):
+            torch_actions = workspace.sample_gaussian_actions(mean, std)
+            if warm_start is not None:
+                torch_actions[0] = warm_start
+
+            cumulative_costs, first_actions = self._evaluate(s, goal, vf, num_rollouts, num_steps, torch_actions)
+
+            elite_idx = np.argsort(cumulative_costs)[:num_elites]
+            elites = torch_actions[torch.as_tensor(elite_idx, device=self.device)]
+            mean = self.cem_alpha * mean + (1. - self.cem_alpha) * elites.mean(dim=0)
+            std = self.cem_alpha * std + (1. - self.cem_alpha) * elites.std(dim=0)
+
+            if cumulative_costs[elite_idx[0]] < best_cost:
+                best_cost = cumulative_costs[elite_idx[0]]
+                best_action = first_actions[elite_idx[0]].copy()
+                best_sequence = elites[0]
+
+        self._save_plan(goal, best_sequence)
+
+        return best_action
+
+    def _mppi(self, s, goal, vf, num_rollouts, num_steps):
+        """ Move the nominal action sequence towards the exponentially cost-weighted average of its perturbations. """
+
+        warm_start = self._get_warm_start()
+        mean = torch.zeros((num_steps, self.action_size), device=self.device) if warm_start is None else warm_start
+        workspace = self.get_workspace(num_rollouts, num_steps)
+
+        for _ in range(self.planner_iterations):
+            torch_actions = workspace.sample_gaussian_actions(mean, self.mppi_noise_std)
+
+            cumulative_costs, _ = self._evaluate(s, goal, vf, num_rollouts, num_steps, torch_actions)
+
+            # Subtract the min cost before exponentiating for numerical stability
+            weights = np.exp(-(cumulative_costs - cumulative_costs.min()) / self.mppi_temperature)
+            weights = torch.as_tensor(weights / weights.sum(), device=self.device).float()
+            mean = torch.tensordot(weights, torch_actions, dims=1)
+
+        self._save_plan(goal, mean)
+
+        return mean[0].cpu().numpy()
+
     def _add_terminal_costs(self, n_step_costs, final_states, goal, num_steps, vf):
         terminal_rewards = self.get_terminal_rewards(final_states, goal, horizon=num_steps, vf=vf)
         terminal_costs = -1 * terminal_rewards.squeeze()
@@ -199,39 +898,59 @@ class MPC:
         return augmented_costs
 
     def step(self, state, action, reward, next_state, done):
-        self.replay_buffer.store(state, action, reward, next_state, done)
+        """ Store a transition, returning its id in the replay buffer. """
+        buffer = self.replay_buffer
+
+        # The FIFO buffer is about to overwrite its oldest transition
+        if buffer.size == buffer.max_size:
+            self._update_standardization_stats(buffer.ptr, remove=True)
+
+        idx = buffer.ptr
+        transition_id = buffer.store(state, action, reward, next_state, done)
+        self._update_standardization_stats(idx)
+
+        # Score the model on new transitions in small batches, before it ever trains on them
+        if self.is_trained and self.drift_eval_every > 0:
+            self.num_unevaluated_transitions += 1
+            if self.num_unevaluated_transitions == self.drift_eval_every:
+                self._update_drift_statistics()
+
+        return transition_id
+
+    def _update_standardization_stats(self, idx, remove=False):
+        state = self.replay_buffer.obs_buf[idx].astype(np.float64)
+        action = self.replay_buffer.act_buf[idx].astype(np.float64)
+        delta = self.replay_buffer.obs2_buf[idx].astype(np.float64) - state
 
-    def _preprocess_data(self):
+        for stats, x in ((self.state_stats, state), (self.action_stats, action), (self.delta_stats, delta)):
+            stats.remove(x) if remove else stats.add(x)
+
+    def _preprocess_data(self, snapshot=False):
+        """ Views over (or copies of) the filled part of the replay buffer; targets are standardized per minibatch in `train`. """
         states = self.replay_buffer.obs_buf[:self.replay_buffer.size, :]
         actions = self.replay_buffer.act_buf[:self.replay_buffer.size, :]
         states_p = self.replay_buffer.obs2_buf[:self.replay_buffer.size, :]
 
         assert states.shape[1] == states_p.shape[1] == self.state_size, f"{states.shape, states_p.shape}"
         assert actions.shape[1] == self.action_size, f"{actions.shape}"
+        assert self.state_stats.count == self.replay_buffer.size, "Transitions were stored without going through MPC.step"
 
-        states_delta = np.array(states_p) - np.array(states)
-        
-        self.mean_x = np.mean(states, axis=0)
-        self.mean_y = np.mean(actions, axis=0)
-        self.mean_z = np.mean(states_delta, axis=0)
-        self.std_x = np.std(states - self.mean_x, axis=0)
-        self.std_y = np.std(actions - self.mean_y, axis=0)
-        self.std_z = np.std(states_delta - self.mean_z, axis=0)
+        self.mean_x, self.std_x = self.state_stats.mean, self.state_stats.std
+        self.mean_y, self.std_y = self.action_stats.mean, self.action_stats.std
+        self.mean_z, self.std_z = self.delta_stats.mean, self.delta_stats.std
 
         self._roundup()
 
-        norm_states_delta = (states_delta - self.mean_z) / self.std_z
-
-        dataset = RolloutDataset(states, actions, norm_states_delta)
+        dataset = RolloutDataset(states, actions, states_p, self.device, ptr=self.replay_buffer.ptr, copy=snapshot)
         return dataset
 
     def _roundup(self, c=1e-5):
         """
-        If any standarization variable is 0, add some constant to prevent NaN
+        If any standarization variable is (numerically) 0, add some constant to prevent NaN
         """
-        self.std_x[self.std_x == 0] = c
-        self.std_y[self.std_y == 0] = c
-        self.std_z[self.std_z == 0] = c
+        self.std_x[self.std_x < c] = c
+        self.std_y[self.std_y < c] = c
+        self.std_z[self.std_z < c] = c
 
     def _get_standardization_vars(self):
         return self.mean_x, self.mean_y, self.mean_z, self.std_x, self.std_y, self.std_z
@@ -247,17 +966,47 @@ class MPC:
     def load_model(self, path):
         with open(path, 'rb') as f:
             state_dictionary = pickle.load(f)
-        self.model = DynamicsModel(self.state_size, self.action_size, self.device)
+        self.model = self._make_model()
         self.model.__setstate__(state_dictionary)
-
-class RolloutDataset(Dataset):
-    def __init__(self, states, actions, states_p):
-        self.states = states
-        self.actions = actions
-        self.states_p = states_p
+        self.student_ready = False
+
+    def _make_model(self):
+        if self.ensemble_size > 1:
+            return EnsembleDynamicsModel(self.state_size, self.action_size, self.device, ensemble_size=self.ensemble_size)
+        return DynamicsModel(self.state_size, self.action_size, self.device)
+
+class RolloutDataset(object):
+    """
+    (state, action, next state) float32 tensors, sampled in whole shuffled minibatches.
+    On the CPU the tensors share memory with the input arrays unless `copy`, on other devices they are copied once.
+    `ptr` is the position after the newest transition when the arrays are (the filled part of) a ring buffer.
+    """
+    def __init__(self, states, actions, states_p, device, ptr=0, copy=False):
+        self.device = device
+        self.ptr = ptr
+        self.copy = copy
+        self.states = self._to_tensor(states)
+        self.actions = self._to_tensor(actions)
+        self.states_p = self._to_tensor(states_p)
     
     def __len__(self):
         return len(self.states)
     
     def __getitem__(self, idx):
         return self.states[idx], self.actions[idx], self.states_p[idx]
+
+    def iterate_minibatches(self, batch_size, shuffle=True):
+        """ One epoch of minibatches gathered with a single index_select per field. """
+        num_samples = len(self)
+        order = torch.randperm(num_samples, device=self.device) if shuffle else torch.arange(num_samples, device=self.device)
+
+        for start in range(0, num_samples, batch_size):
+            yield self.get_minibatch(order[start:start + batch_size])
+
+    def get_minibatch(self, idx):
+        return self.states.index_select(0, idx), self.actions.index_select(0, idx), self.states_p.index_select(0, idx)
+
+    def _to_tensor(self, arr):
+        if self.copy:
+            return torch.tensor(np.asarray(arr, dtype=np.float32), device=self.device)
+        return torch.as_tensor(np.asarray(arr, dtype=np.float32), device=self.device)
@@ -0,0 +1,43 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import numpy as np
+
+
+class ShardedRolloutExecutor:
+    """
+    Runs a population of rollouts as `num_workers` contiguous shards on a pool of threads.
+
+    torch releases the GIL inside its kernels, so the shards execute concurrently while sharing
+    the (read-only) planning model weights in memory. The intra-op parallelism of every shard is
+    torch's process-wide thread count (`torch.set_num_threads`, `--torch_num_threads`), which also
+    applies to all other threads of the process, so choose `num_workers` with both in mind.
+    """
+
+    def __init__(self, num_workers):
+        assert num_workers > 0, num_workers
+
+        self.num_workers = num_workers
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+
+    def get_bounds(self, num_rollouts):
+        """ (start, end) of each shard of a population of `num_rollouts`. """
+        bounds = np.linspace(0, num_rollouts, self.num_workers + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def run(self, rollout_fn, torch_states, torch_goals, num_steps, actions=None, workspace=None, model=None):
+        """ Call `rollout_fn` (see `MPC._rollout_shard`) on every shard and concatenate its outputs in order. """
+        num_rollouts = torch_states.shape[0]
+        shards = workspace.get_shards(self.num_workers) if workspace is not None else [None] * self.num_workers
+
+        futures = []
+        for (start, end), shard_workspace in zip(self.get_bounds(num_rollouts), shards):
+            shard_actions = actions[start:end] if actions is not None else None
+            futures.append(self.pool.submit(rollout_fn, torch_states[start:end], torch_goals[start:end],
+                                            num_steps, shard_actions, shard_workspace, model))
+
+        results = [future.result() for future in futures]
+        return tuple(torch.cat(outputs, dim=0) for outputs in zip(*results))
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
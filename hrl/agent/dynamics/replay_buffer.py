@@ -1,3 +1,5 @@
+import threading
+
 import torch
 import numpy as np
 
@@ -11,6 +13,10 @@ def combined_shape(length, shape=None):
 class ReplayBuffer:
     """
     A simple FIFO experience replay buffer for SAC agents.
+
+    It doubles as the transition store shared by the dynamics model and the TD3 learners
+    (`--shared_transition_store`): every stored transition gets a monotonically increasing id,
+    which other buffers keep instead of a copy of the transition (see `GoalRelabeledReplayBuffer`).
     """
 
     def __init__(self, obs_dim, act_dim, size):
@@ -20,15 +26,32 @@ class ReplayBuffer:
         self.rew_buf = np.zeros(size, dtype=np.float32)
         self.done_buf = np.zeros(size, dtype=np.float32)
         self.ptr, self.size, self.max_size = 0, 0, size
+        self.num_stored = 0
+
+        # Held while a row is overwritten, so that readers on other threads can check that the
+        # transitions they copy are still valid without them being overwritten half-way
+        self.lock = threading.Lock()
 
     def store(self, obs, act, rew, next_obs, done):
-        self.obs_buf[self.ptr] = obs
-        self.obs2_buf[self.ptr] = next_obs
-        self.act_buf[self.ptr] = act
-        self.rew_buf[self.ptr] = rew
-        self.done_buf[self.ptr] = done
-        self.ptr = (self.ptr+1) % self.max_size
-        self.size = min(self.size+1, self.max_size)
+        """ Store a transition and return its id. """
+        with self.lock:
+            transition_id = self.num_stored
+            self.obs_buf[self.ptr] = obs
+            self.obs2_buf[self.ptr] = next_obs
+            self.act_buf[self.ptr] = act
+            self.rew_buf[self.ptr] = rew
+            self.done_buf[self.ptr] = done
+            self.ptr = (self.ptr+1) % self.max_size
+            self.size = min(self.size+1, self.max_size)
+            self.num_stored += 1
+        return transition_id
+
+    def get_rows(self, transition_ids):
+        return np.asarray(transition_ids) % self.max_size
+
+    def is_valid(self, transition_ids):
+        """ Whether the transitions with these ids are still in the buffer, i.e, were not overwritten since. """
+        return np.asarray(transition_ids) >= self.num_stored - self.size
 
     def sample_batch(self, batch_size=32):
         idxs = np.random.randint(0, self.size, size=batch_size)
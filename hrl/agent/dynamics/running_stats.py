@@ -0,0 +1,44 @@
+import numpy as np
+
+
+class RunningMeanStd:
+    """
+    Welford accumulator of the per-dimension mean and (population) std of a stream of vectors.
+    Samples can also be removed again, e.g, when a FIFO replay buffer overwrites them.
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self._mean = np.zeros(self.dim, dtype=np.float64)
+        self._m2 = np.zeros(self.dim, dtype=np.float64)
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (x - self._mean)
+
+    def remove(self, x):
+        assert self.count > 0, "Tried to remove a sample from an empty accumulator"
+
+        if self.count == 1:
+            self.reset()
+            return
+
+        self.count -= 1
+        delta = x - self._mean
+        self._mean -= delta / self.count
+        self._m2 -= delta * (x - self._mean)
+
+    @property
+    def mean(self):
+        return self._mean.astype(np.float32)
+
+    @property
+    def std(self):
+        variance = np.maximum(self._m2, 0.) / max(self.count, 1)
+        return np.sqrt(variance).astype(np.float32)
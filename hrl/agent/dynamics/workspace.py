@@ -0,0 +1,83 @@
+from copy import copy
+
+import torch
+import numpy as np
+
+
+class MPCWorkspace:
+    """
+    Preallocated buffers for `num_rollouts` simulations of length `num_steps`.
+    The planner refills them in place on every control step instead of allocating
+    new tensors, so the returned views are only valid until the next call.
+    """
+
+    def __init__(self, num_rollouts, num_steps, state_size, action_size, gamma, device):
+        self.num_rollouts = num_rollouts
+        self.num_steps = num_steps
+        self.state_size = state_size
+        self.action_size = action_size
+        self.device = device
+
+        # Action sequences and the standard normal noise used to perturb them (CEM/MPPI)
+        self.actions = torch.empty((num_rollouts, num_steps, action_size), device=device)
+        self.noise = torch.empty((num_rollouts, num_steps, action_size), device=device)
+
+        # Per-step uniform actions when the full sequences are not needed (see `MPC._fused_rollout`)
+        self.step_actions = torch.empty((num_rollouts, action_size), device=device)
+        self.first_actions = torch.empty((num_rollouts, action_size), device=device)
+
+        self.states = torch.empty((num_rollouts, state_size), device=device)
+        self.cumulative_costs = torch.empty((num_rollouts,), device=device)
+
+        self.gammas = np.power(gamma * np.ones(num_steps), np.arange(0, num_steps))
+
+        # Only needed by the un-fused `MPC.simulate` path, so allocate them on first use
+        self.predictions = None
+        self.costs = None
+        self.np_goals = None
+
+        # Views of the per-rollout buffers for sharded execution, one list per number of shards
+        self.shards = {}
+
+    def get_shards(self, num_shards):
+        """ Workspaces over `num_shards` contiguous blocks of rollouts that share memory with this one. """
+        if num_shards not in self.shards:
+            bounds = np.linspace(0, self.num_rollouts, num_shards + 1).astype(int)
+            self.shards[num_shards] = [self._get_view(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+        return self.shards[num_shards]
+
+    def _get_view(self, start, end):
+        view = copy(self)
+        view.num_rollouts = end - start
+        view.shards = {}
+        for name in ("actions", "noise", "step_actions", "first_actions", "states", "cumulative_costs"):
+            setattr(view, name, getattr(self, name)[start:end])
+        return view
+
+    def fill_states(self, s):
+        self.states.copy_(torch.as_tensor(s, device=self.device).float().expand_as(self.states))
+        return self.states
+
+    def sample_uniform_actions(self):
+        return self.actions.uniform_(-1., 1.)
+
+    def sample_gaussian_actions(self, mean, std):
+        """ Fill `actions` with clamp(mean + std * N(0, 1), -1, 1) without temporaries. """
+        self.noise.normal_()
+        if isinstance(std, torch.Tensor):
+            torch.addcmul(mean, std, self.noise, out=self.actions)
+        else:
+            torch.add(mean, self.noise, alpha=std, out=self.actions)
+        return self.actions.clamp_(-1., 1.)
+
+    def get_simulation_buffers(self, goal):
+        if self.predictions is None:
+            self.predictions = torch.empty((self.num_rollouts, self.state_size, self.num_steps), device=self.device)
+            self.costs = np.empty((self.num_rollouts, self.num_steps))
+
+        goal = np.asarray(goal)
+        if self.np_goals is None or self.np_goals.shape[1] != goal.shape[0]:
+            self.np_goals = np.empty((self.num_rollouts, goal.shape[0]))
+        self.np_goals[:] = goal
+
+        return self.predictions, self.np_goals, self.costs
@@ -2,11 +2,16 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 
-from hrl.agent.td3.replay_buffer import ReplayBuffer
-from hrl.agent.td3.model import Actor, Critic, NormActor
+from hrl.agent.td3.replay_buffer import ReplayBuffer, TensorReplayBuffer
+from hrl.agent.td3.async_learner import AsyncTD3Learner
+from hrl.agent.td3.model import Actor, Critic, FusedCritic, NormActor
 from hrl.agent.td3.utils import *
 
 
+# `torch.inference_mode` needs torch>=1.9
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+
 # Adapted author implementation of Twin Delayed Deep Deterministic Policy Gradients (TD3)
 # Paper: https://arxiv.org/abs/1802.09477
 
@@ -27,7 +32,13 @@ class TD3(object):
             exploration_noise=0.1,
             lr_c=3e-4, lr_a=3e-4,
             device=torch.device("cuda"),
-            name="Global-TD3-Agent"
+            name="Global-TD3-Agent",
+            replay_buffer=None,
+            replay_storage="numpy",
+            prefetch_batches=False,
+            fused_critic=False,
+            compile_update=False,
+            numpy_inference=False
     ):
 
         self.critic_learning_rate = lr_c
@@ -42,11 +53,20 @@ class TD3(object):
         self.target_actor = copy.deepcopy(self.actor)
         self.actor_optimizer = torch.optim.Adam(self.actor.parameters(), lr=self.actor_learning_rate)
 
-        self.critic = Critic(state_dim, action_dim).to(device)
+        # Both Q networks as one batched matmul per layer (see `FusedCritic`)
+        self.critic = (FusedCritic if fused_critic else Critic)(state_dim, action_dim).to(device)
         self.target_critic = copy.deepcopy(self.critic)
         self.critic_optimizer = torch.optim.Adam(self.critic.parameters(), lr=self.critic_learning_rate)
 
-        self.replay_buffer = ReplayBuffer(state_dim, action_dim, device=device)
+        # E.g, a `GoalRelabeledReplayBuffer` over a transition store shared with other learners. Otherwise
+        # "numpy" storage, or "torch": one float32 tensor on `device`, optionally with background prefetching
+        assert replay_storage in ("numpy", "torch"), replay_storage
+        if replay_buffer is not None:
+            self.replay_buffer = replay_buffer
+        elif replay_storage == "torch":
+            self.replay_buffer = TensorReplayBuffer(state_dim, action_dim, device=device, prefetch=prefetch_batches)
+        else:
+            self.replay_buffer = ReplayBuffer(state_dim, action_dim, device=device)
 
         self.max_action = max_action
         self.action_dim = action_dim
@@ -65,14 +85,45 @@ class TD3(object):
 
         self.total_it = 0
 
+        # (online, target) parameter lists for the multi-tensor polyak updates
+        self.target_pairs = [(list(self.critic.parameters()), list(self.target_critic.parameters())),
+                             (list(self.actor.parameters()), list(self.target_actor.parameters()))]
+
+        # Optionally compile the loss computations of the update step
+        self.critic_loss_fn = self._critic_loss
+        self.actor_loss_fn = self._actor_loss
+        if compile_update:
+            assert hasattr(torch, "compile"), "torch.compile needs torch>=2.0"
+            self.critic_loss_fn = torch.compile(self._critic_loss)
+            self.actor_loss_fn = torch.compile(self._actor_loss)
+
+        # Background learner thread that owns the updates, if started (see `start_async_learner`)
+        self.async_learner = None
+
+        # Single-state inference: a preallocated input for the actor, or (with `numpy_inference`) a NumPy copy
+        # of the actor's weights, refreshed whenever they changed since the last call (see `_numpy_act`)
+        self.numpy_inference = numpy_inference
+        self.act_input = None
+        self.numpy_actor = None
+        self.numpy_actor_key = None
+        self.numpy_actor_source = (None, [])
+
     def act(self, state, evaluation_mode=False):
-        state = torch.FloatTensor(state.reshape(1, -1)).to(self.device)
-        selected_action = self.actor(state)
+        if self.numpy_inference:
+            selected_action = self._numpy_act(state)
+        else:
+            with inference_mode():
+                if self.act_input is None:
+                    self.act_input = torch.empty((1, state.size), dtype=torch.float32, device=self.device)
+                self.act_input.copy_(torch.from_numpy(np.asarray(state, dtype=np.float32).reshape(1, -1)))
 
-        if self.use_output_normalization:
-            selected_action = self.normalize_actions(selected_action)
+                selected_action = self.actor(self.act_input)
+
+                if self.use_output_normalization:
+                    selected_action = self.normalize_actions(selected_action)
+
+                selected_action = selected_action.cpu().numpy().flatten()
 
-        selected_action = selected_action.cpu().data.numpy().flatten()
         noise = np.random.normal(0, self.max_action * self.epsilon, size=self.action_dim)
         if not evaluation_mode:
             selected_action += noise
@@ -83,29 +134,105 @@ class TD3(object):
         if len(actions.shape) == 1:
             actions = actions.unsqueeze(0)
 
-        K = torch.tensor(self.action_dim).to(self.device)
-        G = torch.sum(torch.abs(actions), dim=1).view(-1, 1)
-        G = G / K
-
-        ones = torch.ones(G.size()).to(self.device)
-        G_mod = torch.where(G >= 1, G, ones)
+        # Scale down actions whose mean absolute value exceeds 1
+        G = torch.sum(torch.abs(actions), dim=1, keepdim=True) / self.action_dim
+        G_mod = G.clamp(min=1.)
 
         normalized_actions = actions / G_mod
 
         return normalized_actions
 
+    def _numpy_act(self, state):
+        """ The actor's (normalized) output for a single state, computed with NumPy matmuls. """
+        # The async learner publishes new modules, and in-place updates (optimizer steps, `load_state_dict`)
+        # bump the version counters of the weights
+        if self.numpy_actor_source[0] is not self.actor:
+            self.numpy_actor_source = (self.actor, list(self.actor.parameters()))
+            self.numpy_actor_key = None
+
+        key = tuple(param._version for param in self.numpy_actor_source[1])
+        if key != self.numpy_actor_key:
+            layers = [self.actor.l1, self.actor.l2, self.actor.l3]
+            self.numpy_actor = [(layer.weight.detach().cpu().numpy().T.copy(), layer.bias.detach().cpu().numpy().copy())
+                                for layer in layers]
+            self.numpy_actor_key = key
+
+        (w1, b1), (w2, b2), (w3, b3) = self.numpy_actor
+        a = np.maximum(np.asarray(state, dtype=np.float32) @ w1 + b1, 0.)
+        a = np.maximum(a @ w2 + b2, 0.)
+        a = a @ w3 + b3
+
+        if self.use_output_normalization:
+            return a / max(np.abs(a).sum() / self.action_dim, 1.)
+        return self.max_action * np.tanh(a)
+
     def step(self, state, action, reward, next_state, is_terminal):
+        if self.async_learner is not None:
+            self.async_learner.enqueue("add_transitions", [state], [action], [reward], [next_state], [is_terminal])
+            return
+
         self.replay_buffer.add(state, action, reward, next_state, is_terminal)
 
         if len(self.replay_buffer) > self.batch_size:
             self.train(self.replay_buffer, self.batch_size)
 
+    def add_transitions(self, states, actions, rewards, next_states, is_terminals):
+        """ Bulk version of `step` that only stores the transitions; call `train_steps` to learn from them. """
+        if self.async_learner is not None:
+            self.async_learner.enqueue("add_transitions", states, actions, rewards, next_states, is_terminals)
+            return
+        self.replay_buffer.add_batch(states, actions, rewards, next_states, is_terminals)
+
+    def add_relabeled_transitions(self, transition_ids, goals, is_terminals):
+        """ `add_transitions` for a `GoalRelabeledReplayBuffer`: ids of transitions in its store and their goals. """
+        if self.async_learner is not None:
+            self.async_learner.enqueue("add_relabeled_transitions", transition_ids, goals, is_terminals)
+            return
+        self.replay_buffer.add_batch(transition_ids, goals, is_terminals)
+
+    def start_async_learner(self, update_to_data_ratio=1., publish_every=100):
+        """ From now on, only enqueue transitions and let a background thread decide when to train on them. """
+        assert self.async_learner is None, f"{self.name} already has a learner thread"
+        self.async_learner = AsyncTD3Learner(self, update_to_data_ratio, publish_every)
+
+    def train_steps(self, num_gradient_steps):
+        # The learner thread paces its own updates (`update_to_data_ratio`)
+        if self.async_learner is not None:
+            return
+
+        if len(self.replay_buffer) > self.batch_size:
+            for _ in range(num_gradient_steps):
+                self.train(self.replay_buffer, self.batch_size)
+
     def train(self, replay_buffer, batch_size=100):
         self.total_it += 1
 
         # Sample replay buffer - result is tensors
         state, action, next_state, reward, done = replay_buffer.sample(batch_size)
 
+        # Compute critic loss
+        critic_loss = self.critic_loss_fn(state, action, next_state, reward, done)
+
+        # Optimize the critic
+        self.critic_optimizer.zero_grad()
+        critic_loss.backward()
+        self.critic_optimizer.step()
+
+        # Delayed policy updates
+        if self.total_it % self.policy_freq == 0:
+
+            # Compute actor loss
+            actor_loss = self.actor_loss_fn(state)
+
+            # Optimize the actor
+            self.actor_optimizer.zero_grad()
+            actor_loss.backward()
+            self.actor_optimizer.step()
+
+            # Update the frozen target models
+            self.update_target_networks()
+
+    def _critic_loss(self, state, action, next_state, reward, done):
         with torch.no_grad():
             # Select action according to policy and add clipped noise
             noise = (
@@ -129,31 +256,21 @@ class TD3(object):
         # Get current Q estimates
         current_Q1, current_Q2 = self.critic(state, action)
 
-        # Compute critic loss
-        critic_loss = F.mse_loss(current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q)
-
-        # Optimize the critic
-        self.critic_optimizer.zero_grad()
-        critic_loss.backward()
-        self.critic_optimizer.step()
-
-        # Delayed policy updates
-        if self.total_it % self.policy_freq == 0:
+        return F.mse_loss(current_Q1, target_Q) + F.mse_loss(current_Q2, target_Q)
 
-            # Compute actor loss
-            actor_loss = -self.critic.Q1(state, self.actor(state)).mean()
+    def _actor_loss(self, state):
+        return -self.critic.Q1(state, self.actor(state)).mean()
 
-            # Optimize the actor
-            self.actor_optimizer.zero_grad()
-            actor_loss.backward()
-            self.actor_optimizer.step()
-
-            # Update the frozen target models
-            for param, target_param in zip(self.critic.parameters(), self.target_critic.parameters()):
-                target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
-
-            for param, target_param in zip(self.actor.parameters(), self.target_actor.parameters()):
-                target_param.data.copy_(self.tau * param.data + (1 - self.tau) * target_param.data)
+    def update_target_networks(self):
+        """ target <- tau * online + (1 - tau) * target, for all parameters at once where `_foreach` ops exist. """
+        with torch.no_grad():
+            for params, target_params in self.target_pairs:
+                if hasattr(torch, "_foreach_mul_"):
+                    torch._foreach_mul_(target_params, 1 - self.tau)
+                    torch._foreach_add_(target_params, params, alpha=self.tau)
+                else:
+                    for param, target_param in zip(params, target_params):
+                        target_param.mul_(1 - self.tau).add_(param, alpha=self.tau)
 
     def update_epsilon(self):
         """ We are using fixed (default) epsilons for TD3 because tuning it is hard. """
@@ -0,0 +1,118 @@
+import copy
+import queue
+import atexit
+import threading
+
+import torch
+
+
+class AsyncTD3Learner:
+    """
+    Runs the gradient updates of a `TD3` agent on a background thread (see `TD3.start_async_learner`).
+
+    The acting thread only enqueues transitions. The learner thread inserts them into the agent's
+    replay buffer, takes `update_to_data_ratio` gradient steps per inserted transition on its own
+    copy of the networks and optimizers, and publishes copies of the trained networks to the agent,
+    i.e, to the acting policy and value function, every `publish_every` updates.
+    """
+
+    networks = ("actor", "critic", "target_actor", "target_critic")
+
+    def __init__(self, agent, update_to_data_ratio=1., publish_every=100):
+        assert update_to_data_ratio > 0, update_to_data_ratio
+        assert publish_every > 0, publish_every
+
+        self.agent = agent
+        self.update_to_data_ratio = update_to_data_ratio
+        self.publish_every = publish_every
+
+        self.learner = self._make_learner(agent)
+        self.replay_buffer = agent.replay_buffer
+
+        self.transitions = queue.Queue()
+        self.num_pending_updates = 0.
+        self.num_updates = 0
+        self.error = None
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=f"{agent.name}-learner", daemon=True)
+        self.thread.start()
+
+        # A daemon thread still running torch ops while the interpreter shuts down aborts the process
+        atexit.register(self._stop_thread)
+
+    @classmethod
+    def _make_learner(cls, agent):
+        """ Shallow copy of `agent` (sharing its replay buffer and hyperparameters) with its own networks and optimizers. """
+        learner = copy.copy(agent)
+        learner.async_learner = None
+
+        for network in cls.networks:
+            setattr(learner, network, copy.deepcopy(getattr(agent, network)))
+
+        for network in ("actor", "critic"):
+            old_optimizer = getattr(agent, f"{network}_optimizer")
+            optimizer = type(old_optimizer)(getattr(learner, network).parameters(), **old_optimizer.defaults)
+            optimizer.load_state_dict(old_optimizer.state_dict())
+            setattr(learner, f"{network}_optimizer", optimizer)
+
+        learner.target_pairs = [(list(learner.critic.parameters()), list(learner.target_critic.parameters())),
+                                (list(learner.actor.parameters()), list(learner.target_actor.parameters()))]
+
+        # Re-bind the loss functions to the copy, compiling them again if the agent's are compiled
+        compiled = agent.critic_loss_fn != agent._critic_loss
+        learner.critic_loss_fn = torch.compile(learner._critic_loss) if compiled else learner._critic_loss
+        learner.actor_loss_fn = torch.compile(learner._actor_loss) if compiled else learner._actor_loss
+
+        return learner
+
+    def enqueue(self, method, *args):
+        """ Have the learner thread call `method` ("add_transitions" or "add_relabeled_transitions") with `args`. """
+        if self.error is not None:
+            raise RuntimeError(f"The learner thread of {self.agent.name} failed") from self.error
+        self.transitions.put((method, args))
+
+    def publish(self):
+        for network in self.networks:
+            setattr(self.agent, network, copy.deepcopy(getattr(self.learner, network)))
+
+    def stop(self):
+        """ Stop the learner thread (pending updates are dropped) and publish the latest networks. """
+        self._stop_thread()
+        self.publish()
+
+    def _stop_thread(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        try:
+            while not self.stopped.is_set():
+                self._insert_transitions(block=self.num_pending_updates < 1)
+
+                if self.num_pending_updates >= 1:
+                    self.learner.train(self.replay_buffer, self.learner.batch_size)
+                    self.num_pending_updates -= 1
+                    self.num_updates += 1
+
+                    if self.num_updates % self.publish_every == 0:
+                        self.publish()
+        except Exception as e:
+            self.error = e
+            raise
+
+    def _insert_transitions(self, block):
+        """ Drain the queue into the replay buffer (waiting briefly for transitions if `block`). """
+        try:
+            item = self.transitions.get(timeout=0.1) if block else self.transitions.get_nowait()
+            while True:
+                method, args = item
+                getattr(self.learner, method)(*args)
+
+                # Like `TD3.train_steps`, only learn once the buffer holds more than a minibatch
+                if len(self.replay_buffer) > self.learner.batch_size:
+                    self.num_pending_updates += self.update_to_data_ratio * len(args[0])
+
+                item = self.transitions.get_nowait()
+        except queue.Empty:
+            pass
@@ -0,0 +1,130 @@
+"""
+TD3 gradient updates per second of the different critic/update implementations, e.g,
+
+    python -m hrl.agent.td3.benchmark --device cpu --num_updates 2000
+
+Before it is timed, the fused critic (`--td3_fused_critic`) is loaded with the weights of the
+twin-MLP `Critic` and the largest deviation of its Q-values is reported. "compile" is the fused
+critic with torch.compile'd losses (`--td3_compile_update`, torch>=2.0).
+
+It also reports the latency of `TD3.act` on a single state with the torch actor and with the
+NumPy copy of its weights (`--td3_numpy_inference`), and the largest difference between the two.
+"""
+import time
+import argparse
+
+import torch
+import numpy as np
+
+from hrl.agent.td3.TD3AgentClass import TD3
+from hrl.agent.td3.model import Critic, FusedCritic
+
+
+MODES = {
+    "default": dict(),
+    "fused": dict(fused_critic=True),
+    "compile": dict(fused_critic=True, compile_update=True),
+}
+
+
+def make_agent(mode, args, device):
+    agent = TD3(args.state_size, args.action_size, max_action=1., batch_size=args.batch_size,
+                device=device, replay_storage=args.replay_storage, **MODES[mode])
+
+    n = args.buffer_size
+    agent.add_transitions(np.random.randn(n, args.state_size), np.random.uniform(-1, 1, (n, args.action_size)),
+                          -np.random.rand(n), np.random.randn(n, args.state_size), np.random.rand(n) < 0.05)
+    return agent
+
+
+def critic_error(state_size, action_size, device, batch_size=1024):
+    """ Largest difference between the Q-values of a `Critic` and a `FusedCritic` with the same weights. """
+    critic = Critic(state_size, action_size).to(device)
+    fused = FusedCritic(state_size, action_size).to(device)
+    fused.load_from_critic(critic)
+
+    states = torch.randn((batch_size, state_size), device=device)
+    actions = torch.rand((batch_size, action_size), device=device) * 2 - 1
+    with torch.no_grad():
+        errors = [(q - fused_q).abs().max().item() for q, fused_q in zip(critic(states, actions), fused(states, actions))]
+        errors.append((critic.Q1(states, actions) - fused.Q1(states, actions)).abs().max().item())
+    return max(errors)
+
+
+def time_updates(agent, num_updates, warmup_updates):
+    agent.train_steps(warmup_updates)  # lazy initialization / compilation
+
+    start_time = time.perf_counter()
+    agent.train_steps(num_updates)
+    return num_updates / (time.perf_counter() - start_time)
+
+
+def time_act(agent, states):
+    """ Seconds per `TD3.act` call (without exploration noise). """
+    agent.act(states[0], evaluation_mode=True)  # preallocation / weight copy
+
+    start_time = time.perf_counter()
+    for state in states:
+        agent.act(state, evaluation_mode=True)
+    return (time.perf_counter() - start_time) / len(states)
+
+
+def act_error(torch_agent, numpy_agent, states):
+    return max(np.abs(torch_agent.act(s, evaluation_mode=True) - numpy_agent.act(s, evaluation_mode=True)).max()
+               for s in states)
+
+
+def run_act_benchmark(args, device):
+    print(f"\n{'actor':>12} | {'latency (us)':>12}")
+    for use_output_normalization in (True, False):
+        torch_agent = TD3(args.state_size, args.action_size, max_action=1., device=device,
+                          use_output_normalization=use_output_normalization)
+        numpy_agent = TD3(args.state_size, args.action_size, max_action=1., device=device,
+                          use_output_normalization=use_output_normalization, numpy_inference=True)
+        numpy_agent.actor.load_state_dict(torch_agent.actor.state_dict())
+
+        states = np.random.randn(args.num_act_calls, args.state_size)
+        name = "norm" if use_output_normalization else "tanh"
+        print(f"{name + '/torch':>12} | {1e6 * time_act(torch_agent, states):>12.1f}")
+        print(f"{name + '/numpy':>12} | {1e6 * time_act(numpy_agent, states):>12.1f}"
+              f"   (max |a_torch - a_numpy|: {act_error(torch_agent, numpy_agent, states[:100]):.1e})")
+
+
+def run_benchmark(args):
+    device = torch.device(args.device)
+    print(f"Fused critic max |Q - Q_fused|: {critic_error(args.state_size, args.action_size, device):.2e}\n")
+
+    print(f"{'mode':>8} | {'updates/s':>9} | {'speedup':>7}")
+    base_rate = None
+    for mode in args.modes:
+        if mode == "compile" and not hasattr(torch, "compile"):
+            print(f"{mode:>8} | torch.compile needs torch>=2.0")
+            continue
+
+        rate = time_updates(make_agent(mode, args, device), args.num_updates, args.warmup_updates)
+        base_rate = rate if base_rate is None else base_rate
+        print(f"{mode:>8} | {rate:>9.1f} | {rate / base_rate:>7.2f}")
+
+    if args.num_act_calls > 0:
+        run_act_benchmark(args, device)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--state_size", type=int, default=31, help="goal-augmented state size")
+    parser.add_argument("--action_size", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--buffer_size", type=int, default=100000)
+    parser.add_argument("--replay_storage", type=str, default="numpy", choices=["numpy", "torch"])
+    parser.add_argument("--num_updates", type=int, default=1000)
+    parser.add_argument("--warmup_updates", type=int, default=50)
+    parser.add_argument("--num_act_calls", type=int, default=10000, help="single-state act calls to time (0 skips)")
+    parser.add_argument("--num_threads", type=int, default=0, help="torch intra-op threads (0 keeps the default)")
+    parser.add_argument("--modes", nargs="+", default=["default", "fused"], choices=list(MODES))
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    run_benchmark(args)
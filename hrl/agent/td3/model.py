@@ -68,3 +68,50 @@ class Critic(nn.Module):
         q1 = self.l3(q1)
         return q1
 
+
+
+class FusedCritic(nn.Module):
+    """
+    `Critic` with the weights of the two Q networks stacked along a leading dimension, so that both
+    heads are evaluated by one batched matmul per layer instead of two separate MLPs.
+    """
+    def __init__(self, state_dim, action_dim, hidden_size=256, num_heads=2):
+        super(FusedCritic, self).__init__()
+
+        sizes = [state_dim + action_dim, hidden_size, hidden_size, 1]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+
+        for fan_in, fan_out in zip(sizes[:-1], sizes[1:]):
+            # Same initialization as `nn.Linear`
+            bound = 1. / fan_in ** 0.5
+            self.weights.append(nn.Parameter(torch.empty(num_heads, fan_in, fan_out).uniform_(-bound, bound)))
+            self.biases.append(nn.Parameter(torch.empty(num_heads, 1, fan_out).uniform_(-bound, bound)))
+
+    def forward(self, state, action):
+        sa = torch.cat([state, action], 1)
+
+        q = sa.unsqueeze(0).expand(self.weights[0].shape[0], -1, -1)
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            q = torch.baddbmm(bias, q, weight)
+            if i < len(self.weights) - 1:
+                q = F.relu(q)
+        return q[0], q[1]
+
+    def Q1(self, state, action):
+        sa = torch.cat([state, action], 1)
+
+        q1 = sa
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            q1 = torch.addmm(bias[0], q1, weight[0])
+            if i < len(self.weights) - 1:
+                q1 = F.relu(q1)
+        return q1
+
+    def load_from_critic(self, critic):
+        """ Copy the weights of a `Critic`, e.g, to compare the two implementations. """
+        layers = [(critic.l1, critic.l4), (critic.l2, critic.l5), (critic.l3, critic.l6)]
+        with torch.no_grad():
+            for weight, bias, heads in zip(self.weights, self.biases, layers):
+                weight.copy_(torch.stack([layer.weight.t() for layer in heads]))
+                bias.copy_(torch.stack([layer.bias.unsqueeze(0) for layer in heads]))
@@ -1,25 +1,30 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import torch
 
 
 class ReplayBuffer(object):
-	def __init__(self, state_dim, action_dim, max_size=int(1e6), device=torch.device("cuda")):
+	"""
+	FIFO buffer of float32 transitions with a compact boolean `done`. Storage is allocated
+	lazily in whole chunks of `chunk_size` rows (doubling as it grows) up to `max_size`,
+	so memory scales with the data actually collected rather than with the cap.
+	"""
+	columns = ("state", "action", "next_state", "reward", "done")
+
+	def __init__(self, state_dim, action_dim, max_size=int(1e6), device=torch.device("cuda"), chunk_size=int(1e4)):
 		self.max_size = max_size
 		self.state_dim = state_dim
 		self.action_dim = action_dim
-
-		self.ptr = 0
-		self.size = 0
-
-		self.state = np.zeros((max_size, state_dim))
-		self.action = np.zeros((max_size, action_dim))
-		self.next_state = np.zeros((max_size, state_dim))
-		self.reward = np.zeros((max_size, 1))
-		self.done = np.zeros((max_size, 1))
+		self.chunk_size = chunk_size
 
 		self.device = device
 
+		self.clear()
+
 	def add(self, state, action, reward, next_state, done):
+		self._reserve(1)
+
 		self.state[self.ptr] = state
 		self.action[self.ptr] = action
 		self.reward[self.ptr] = reward
@@ -29,16 +34,30 @@ class ReplayBuffer(object):
 		self.ptr = (self.ptr + 1) % self.max_size
 		self.size = min(self.size + 1, self.max_size)
 
+	def add_batch(self, states, actions, rewards, next_states, dones):
+		""" Bulk `add` of N transitions, wrapping around the end of the buffer. """
+		n = len(states)
+		self._reserve(n)
+		idx = (self.ptr + np.arange(n)) % self.max_size
+
+		self.state[idx] = states
+		self.action[idx] = actions
+		self.reward[idx] = np.asarray(rewards).reshape(-1, 1)
+		self.next_state[idx] = next_states
+		self.done[idx] = np.asarray(dones).reshape(-1, 1)
+
+		self.ptr = (self.ptr + n) % self.max_size
+		self.size = min(self.size + n, self.max_size)
 
 	def sample(self, batch_size):
 		ind = np.random.randint(0, self.size, size=batch_size)
 
 		return (
-			torch.FloatTensor(self.state[ind]).to(self.device),
-			torch.FloatTensor(self.action[ind]).to(self.device),
-			torch.FloatTensor(self.next_state[ind]).to(self.device),
-			torch.FloatTensor(self.reward[ind]).to(self.device),
-			torch.FloatTensor(self.done[ind]).to(self.device)
+			self._to_tensor(self.state[ind]),
+			self._to_tensor(self.action[ind]),
+			self._to_tensor(self.next_state[ind]),
+			self._to_tensor(self.reward[ind]),
+			self._to_tensor(self.done[ind])
 		)
 
 	def __len__(self):
@@ -49,12 +68,289 @@ class ReplayBuffer(object):
 			return self.state[i], self.action[i], self.reward[i], self.next_state[i], self.done[i]
 		raise IndexError(f"Tried to access index {i} when length is {self.size}")
 
+	def get_states_actions(self):
+		""" (states, actions) of every stored transition, as host arrays. """
+		return self.state[:self.size], self.action[:self.size]
+
+	def clear(self):
+		self.ptr = 0
+		self.size = 0
+		self.capacity = 0
+
+		self.state = np.zeros((0, self.state_dim), dtype=np.float32)
+		self.action = np.zeros((0, self.action_dim), dtype=np.float32)
+		self.next_state = np.zeros((0, self.state_dim), dtype=np.float32)
+		self.reward = np.zeros((0, 1), dtype=np.float32)
+		self.done = np.zeros((0, 1), dtype=bool)
+
+	def _reserve(self, n):
+		""" Grow the storage so that the next `n` transitions fit (the buffer only wraps once it reaches `max_size`). """
+		required = min(self.ptr + n, self.max_size)
+		if required <= self.capacity:
+			return
+
+		num_chunks = -(-max(required, 2 * self.capacity) // self.chunk_size)
+		self.capacity = min(num_chunks * self.chunk_size, self.max_size)
+
+		for name in self.columns:
+			old = getattr(self, name)
+			new = np.zeros((self.capacity, old.shape[1]), dtype=old.dtype)
+			# Storage only grows before the buffer wraps, so every entry is before `ptr`
+			new[:self.ptr] = old[:self.ptr]
+			setattr(self, name, new)
+
+	def _to_tensor(self, arr):
+		return torch.as_tensor(arr, dtype=torch.float32).to(self.device)
+
+
+class TensorReplayBuffer(ReplayBuffer):
+	"""
+	`ReplayBuffer` that keeps all fields of a transition in one row of a contiguous float32 torch
+	tensor on `device`, laid out as [state | action | next_state | reward | done]. A minibatch is a
+	single `index_select` into a preallocated output tensor, so `sample` returns views that are only
+	valid until the next call. With `prefetch`, the next minibatch is gathered on a background thread
+	(into a second output tensor) while the caller uses the current one.
+	"""
+	def __init__(self, state_dim, action_dim, max_size=int(1e6), device=torch.device("cuda"), chunk_size=int(1e4), prefetch=False):
+		self.width = 2 * state_dim + action_dim + 2
+		self.prefetch = prefetch
+		self.prefetcher = ThreadPoolExecutor(max_workers=1) if prefetch else None
+		self.next_batch = None
+
+		super().__init__(state_dim, action_dim, max_size=max_size, device=device, chunk_size=chunk_size)
+
+	def add(self, state, action, reward, next_state, done):
+		self.add_batch([state], [action], [reward], [next_state], [done])
+
+	def add_batch(self, states, actions, rewards, next_states, dones):
+		""" Bulk `add` of N transitions, wrapping around the end of the buffer. """
+		self._wait_for_prefetch()
+
+		n = len(states)
+		self._reserve(n)
+		rows = np.concatenate((np.asarray(states, dtype=np.float32).reshape(n, -1),
+							   np.asarray(actions, dtype=np.float32).reshape(n, -1),
+							   np.asarray(next_states, dtype=np.float32).reshape(n, -1),
+							   np.asarray(rewards, dtype=np.float32).reshape(n, 1),
+							   np.asarray(dones, dtype=np.float32).reshape(n, 1)), axis=1)
+		idx = torch.as_tensor((self.ptr + np.arange(n)) % self.max_size, device=self.device)
+		self.storage.index_copy_(0, idx, torch.as_tensor(rows, device=self.device))
+
+		self.ptr = (self.ptr + n) % self.max_size
+		self.size = min(self.size + n, self.max_size)
+
+	def sample(self, batch_size):
+		if not self.prefetch:
+			return self._split(self._gather(batch_size, 0))
+
+		if self.next_batch is None or self.next_batch[0] != batch_size:
+			self._wait_for_prefetch(discard=True)
+			batch, slot = self._gather(batch_size, 0), 0
+		else:
+			batch, slot = self.next_batch[1].result(), self.next_batch[2]
+
+		# The rows are drawn now, so that transitions added later cannot be torn by the background gather
+		ind = self._sample_indices(batch_size)
+		self.next_batch = (batch_size, self.prefetcher.submit(self._gather, batch_size, 1 - slot, ind), 1 - slot)
+		return self._split(batch)
+
+	def __getitem__(self, i):
+		if i < self.size:
+			row = self.storage[i].cpu().numpy()
+			state, action, next_state, reward, done = np.split(row, self._get_offsets())
+			return state, action, reward, next_state, done
+		raise IndexError(f"Tried to access index {i} when length is {self.size}")
+
+	def get_states_actions(self):
+		rows = self.storage[:self.size, :self.state_dim + self.action_dim].cpu().numpy()
+		return rows[:, :self.state_dim], rows[:, self.state_dim:]
+
+	def clear(self):
+		self._wait_for_prefetch(discard=True)
+
+		self.ptr = 0
+		self.size = 0
+		self.capacity = 0
+
+		self.storage = torch.zeros((0, self.width), dtype=torch.float32, device=self.device)
+		self.batches = [None, None]
+
+	def _reserve(self, n):
+		required = min(self.ptr + n, self.max_size)
+		if required <= self.capacity:
+			return
+
+		num_chunks = -(-max(required, 2 * self.capacity) // self.chunk_size)
+		self.capacity = min(num_chunks * self.chunk_size, self.max_size)
+
+		storage = torch.zeros((self.capacity, self.width), dtype=torch.float32, device=self.device)
+		storage[:self.size] = self.storage[:self.size]
+		self.storage = storage
+
+	def _sample_indices(self, batch_size):
+		return torch.randint(0, self.size, (batch_size,), device=self.device)
+
+	def _gather(self, batch_size, slot, ind=None):
+		""" Gather a minibatch into the output tensor `slot` (one per in-flight batch). """
+		if self.batches[slot] is None or self.batches[slot].shape[0] != batch_size:
+			self.batches[slot] = torch.empty((batch_size, self.width), dtype=torch.float32, device=self.device)
+
+		ind = self._sample_indices(batch_size) if ind is None else ind
+		return torch.index_select(self.storage, 0, ind, out=self.batches[slot])
+
+	def _split(self, batch):
+		""" (state, action, next_state, reward, done) column views of a gathered minibatch, as in `ReplayBuffer.sample`. """
+		return torch.split(batch, [self.state_dim, self.action_dim, self.state_dim, 1, 1], dim=1)
+
+	def _get_offsets(self):
+		return np.cumsum([self.state_dim, self.action_dim, self.state_dim, 1])
+
+	def _wait_for_prefetch(self, discard=False):
+		""" Let the background gather finish before the storage changes; its batch stays usable unless discarded. """
+		if self.next_batch is not None:
+			self.next_batch[1].result()
+			if discard:
+				self.next_batch = None
+
+
+class GoalRelabeledReplayBuffer(ReplayBuffer):
+	"""
+	Index view of a shared transition store (`hrl.agent.dynamics.replay_buffer.ReplayBuffer`) for a
+	goal-conditioned learner. Every entry is only the id of an environment transition, the goal it is
+	relabeled with and its `done` flag; the goal-augmented states and the rewards are assembled from
+	the store when a batch is sampled.
+
+	Entries must be added in order of their transition ids, so that the entries whose transition
+	has been overwritten in the store are always the oldest ones; they are evicted before the buffer
+	is sampled or measured, and `len` only counts entries that can still be sampled.
+	"""
+	columns = ("transition_id", "goal", "done")
+
+	def __init__(self, transition_store, reward_func, goal_dim=2, max_size=int(1e6), device=torch.device("cuda"), chunk_size=int(1e4)):
+		self.transition_store = transition_store
+		self.reward_func = reward_func
+		self.goal_dim = goal_dim
+
+		super().__init__(transition_store.obs_buf.shape[1] + goal_dim, transition_store.act_buf.shape[1],
+						 max_size=max_size, device=device, chunk_size=chunk_size)
+
+	def add(self, transition_id, goal, done):
+		self.add_batch([transition_id], [goal], [done])
+
+	def add_batch(self, transition_ids, goals, dones):
+		""" Bulk insert of N (transition id, relabeled goal, done) entries, in non-decreasing order of ids. """
+		transition_ids = np.asarray(transition_ids).reshape(-1, 1)
+		assert np.all(np.diff(transition_ids[:, 0]) >= 0), "Entries must be added in order of their transition ids"
+		assert self.size == 0 or transition_ids[0, 0] >= self.transition_id[(self.ptr - 1) % self.max_size, 0]
+
+		n = len(transition_ids)
+		self._reserve(n)
+		idx = (self.ptr + np.arange(n)) % self.max_size
+
+		self.transition_id[idx] = transition_ids
+		self.goal[idx] = goals
+		self.done[idx] = np.asarray(dones).reshape(-1, 1)
+
+		self.ptr = (self.ptr + n) % self.max_size
+		self.size = min(self.size + n, self.max_size)
+		self._evict_stale_entries()
+
+	def sample(self, batch_size):
+		self._evict_stale_entries()
+		assert self.size > 0, "Tried to sample from a buffer without valid entries"
+
+		# Redraw entries whose transition got overwritten since (e.g, by the acting thread of an async learner)
+		ind = self._sample_indices(batch_size)
+		states, actions, rewards, next_states, valid = self._gather(ind)
+		while not valid.all():
+			self._evict_stale_entries()
+			assert self.size > 0, "All entries of the buffer were overwritten while sampling"
+
+			stale = ~valid
+			ind[stale] = self._sample_indices(stale.sum())
+			*redrawn, redrawn_valid = self._gather(ind[stale])
+			valid[stale] = redrawn_valid
+			for batch, redrawn_batch in zip((states, actions, rewards, next_states), redrawn):
+				batch[stale] = redrawn_batch
+
+		return (
+			self._to_tensor(states),
+			self._to_tensor(actions),
+			self._to_tensor(next_states),
+			self._to_tensor(rewards),
+			self._to_tensor(self.done[ind])
+		)
+
+	def __len__(self):
+		self._evict_stale_entries()
+		return self.size
+
+	def __getitem__(self, i):
+		if i < self.size:
+			idx = (self.ptr - self.size + i) % self.max_size
+			state, action, reward, next_state, _ = self._gather([idx])
+			return state[0], action[0], reward[0], next_state[0], self.done[idx]
+		raise IndexError(f"Tried to access index {i} when length is {self.size}")
+
+	def get_states_actions(self):
+		""" Goal-augmented states and actions of every entry whose transition is still in the store. """
+		self._evict_stale_entries()
+		ind = (self.ptr - self.size + np.arange(self.size)) % self.max_size
+		store = self.transition_store
+		transition_ids = self.transition_id[ind, 0]
+		rows = store.get_rows(transition_ids)
+
+		with store.lock:
+			valid = store.is_valid(transition_ids)
+			states, actions = store.obs_buf[rows], store.act_buf[rows]
+
+		states = np.concatenate((states, self.goal[ind]), axis=1)
+		return states[valid], actions[valid]
+
 	def clear(self):
 		self.ptr = 0
 		self.size = 0
+		self.capacity = 0
+
+		self.transition_id = np.zeros((0, 1), dtype=np.int64)
+		self.goal = np.zeros((0, self.goal_dim), dtype=np.float32)
+		self.done = np.zeros((0, 1), dtype=bool)
+
+	def _sample_indices(self, n):
+		""" Positions of `n` random entries, the oldest of which is at `ptr - size`. """
+		return (self.ptr - self.size + np.random.randint(0, self.size, size=n)) % self.max_size
+
+	def _evict_stale_entries(self):
+		""" Drop the oldest entries, whose transitions are no longer in the store. """
+		if self.size == 0:
+			return
+
+		oldest_valid_id = self.transition_store.num_stored - self.transition_store.size
+		head = (self.ptr - self.size) % self.max_size
+
+		# The entries from `head` on, in order (at most two contiguous segments of the ring), have sorted ids
+		first_segment = self.transition_id[head:min(head + self.size, self.max_size), 0]
+		num_stale = np.searchsorted(first_segment, oldest_valid_id)
+		if num_stale == len(first_segment) and len(first_segment) < self.size:
+			num_stale += np.searchsorted(self.transition_id[:self.size - len(first_segment), 0], oldest_valid_id)
+
+		self.size -= int(num_stale)
+
+	def _gather(self, ind):
+		""" Goal-augmented (states, actions, rewards, next_states) of the entries at `ind`, and whether
+		each of their transitions was still in the store when it was copied. """
+		store = self.transition_store
+		transition_ids = self.transition_id[ind, 0]
+		rows = store.get_rows(transition_ids)
+		goals = self.goal[ind]
+
+		# The store can be written by another thread; rows are only copied while it cannot change
+		with store.lock:
+			valid = store.is_valid(transition_ids)
+			states, actions, next_states = store.obs_buf[rows], store.act_buf[rows], store.obs2_buf[rows]
+
+		rewards, _ = self.reward_func(next_states, goals, batched=True)
 
-		self.state = np.zeros((self.max_size, self.state_dim))
-		self.action = np.zeros((self.max_size, self.action_dim))
-		self.next_state = np.zeros((self.max_size, self.state_dim))
-		self.reward = np.zeros((self.max_size, 1))
-		self.done = np.zeros((self.max_size, 1))
+		states = np.concatenate((states, goals), axis=1)
+		next_states = np.concatenate((next_states, goals), axis=1)
+		return states, actions, np.asarray(rewards, dtype=np.float32).reshape(-1, 1), next_states, valid
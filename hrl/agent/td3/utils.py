@@ -25,8 +25,7 @@ def load(td3_agent, filename):
 
 def make_chunked_value_function_plot(solver, episode, seed, experiment_name, chunk_size=1000, replay_buffer=None):
     replay_buffer = replay_buffer if replay_buffer is not None else solver.replay_buffer
-    states = np.array([exp[0] for exp in replay_buffer])
-    actions = np.array([exp[1] for exp in replay_buffer])
+    states, actions = replay_buffer.get_states_actions()
 
     # Chunk up the inputs so as to conserve GPU memory
     num_chunks = int(np.ceil(states.shape[0] / chunk_size))
@@ -66,6 +66,32 @@ class D4RLAntMazeWrapper(GoalConditionedMDPWrapper):
 
 		return rewards, dones
 	
+	def sparse_gc_reward_func_torch(self, states, goals):
+		"""
+		batched torch version of `sparse_gc_reward_func`, keeps the computation on the states' device
+		"""
+		assert isinstance(states, torch.Tensor)
+		assert isinstance(goals, torch.Tensor)
+
+		distances = torch.norm(states[:,:2] - goals[:,:2], dim=-1)
+		dones = distances <= float(self.goal_tolerance)
+		rewards = dones.float() - 1.
+
+		return rewards, dones
+
+	def dense_gc_reward_func_torch(self, states, goals):
+		"""
+		batched torch version of `dense_gc_reward_func`, keeps the computation on the states' device
+		"""
+		assert isinstance(states, torch.Tensor)
+		assert isinstance(goals, torch.Tensor)
+
+		distances = torch.norm(states[:,:2] - goals[:,:2], dim=-1)
+		dones = distances <= float(self.goal_tolerance)
+		rewards = torch.where(dones, torch.zeros_like(distances), -distances)
+
+		return rewards, dones
+
 	def step(self, action):
 		next_state, reward, done, info = self.env.step(action)
 		reward, done = self.reward_func(next_state, self.get_current_goal())
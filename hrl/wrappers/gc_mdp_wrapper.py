@@ -48,6 +48,22 @@ class GoalConditionedMDPWrapper(Wrapper):
         """
         pass
 
+    @abstractmethod
+    def sparse_gc_reward_func_torch(self, states, goals):
+        """
+        batched torch version of the sparse reward func, used by the planner to
+        score rollouts without leaving the device. always overwrite this function
+        """
+        pass
+
+    @abstractmethod
+    def dense_gc_reward_func_torch(self, states, goals):
+        """
+        batched torch version of the dense reward func, used by the planner to
+        score rollouts without leaving the device. always overwrite this function
+        """
+        pass
+
     def reset(self):
         self.init_state = self.env.reset()
         self.cur_state = deepcopy(self.init_state)